@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, List, Optional
+
+
+class MicroBatcher:
+    """Group submitted items by key and run them through one batched call.
+
+    Items sharing a key are collected until either ``max_batch_size`` items are
+    pending or ``max_wait`` seconds have passed since the first one arrived.
+    ``run_batch(key, items)`` must return one result per item; a result that is
+    an exception is raised only to the submitter of that item. If the batched
+    call itself raises, each item is retried in a batch of its own, so only the
+    items that also fail alone see an error. Up to ``concurrency`` batches run
+    at the same time.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, List[Any]], Awaitable[List[Any]]],
+        max_batch_size: int = 4,
+        max_wait: float = 0.05,
+        concurrency: int = 1,
+        on_batch: Optional[Callable[[Hashable, int], None]] = None
+    ):
+        self._run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.concurrency = max(1, concurrency)
+        self._on_batch = on_batch
+        self._groups: "OrderedDict[Hashable, dict]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._runners: List[asyncio.Task] = []
+
+    async def submit(self, key: Hashable, item: Any) -> Any:
+        """Queue ``item`` under ``key`` and wait for its result"""
+        self._runners = [runner for runner in self._runners if not runner.done()]
+        while len(self._runners) < self.concurrency:
+            self._runners.append(asyncio.create_task(self._run()))
+
+        future = asyncio.get_running_loop().create_future()
+        group = self._groups.get(key)
+        if group is None:
+            group = {"deadline": time.monotonic() + self.max_wait, "entries": []}
+            self._groups[key] = group
+        group["entries"].append((item, future))
+        self._wakeup.set()
+        return await future
+
+    def _pop_ready(self):
+        now = time.monotonic()
+        for key, group in self._groups.items():
+            entries = group["entries"]
+            if len(entries) >= self.max_batch_size or group["deadline"] <= now:
+                batch = entries[:self.max_batch_size]
+                remaining = entries[self.max_batch_size:]
+                if remaining:
+                    group["entries"] = remaining
+                    group["deadline"] = now + self.max_wait
+                else:
+                    del self._groups[key]
+                return key, batch
+        return None
+
+    def _next_deadline(self) -> Optional[float]:
+        if not self._groups:
+            return None
+        return min(group["deadline"] for group in self._groups.values())
+
+    async def _call(self, key: Hashable, items: List[Any]) -> List[Any]:
+        try:
+            return await self._run_batch(key, items)
+        except Exception as e:
+            if len(items) == 1:
+                return [e]
+        # Isolate the item that broke the batch
+        results = []
+        for item in items:
+            results += await self._call(key, [item])
+        return results
+
+    async def _run(self):
+        while True:
+            ready = self._pop_ready()
+            if ready is None:
+                self._wakeup.clear()
+                deadline = self._next_deadline()
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            key, batch = ready
+            items = [item for item, _ in batch]
+            if self._on_batch:
+                self._on_batch(key, len(items))
+            results = await self._call(key, items)
+
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
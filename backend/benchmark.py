@@ -0,0 +1,382 @@
+"""End-to-end throughput benchmark of the API -> broker -> worker -> database path.
+
+Runs the FastAPI app and the worker in one process without a GPU, SD weights,
+RabbitMQ or Postgres:
+
+- the diffusion pipeline and preprocessors are replaced by a CPU stub with
+  configurable latency (``--backend stub``) or a tiny randomly initialised
+  diffusers ControlNet pipeline (``--backend tiny``),
+- RabbitMQ is replaced by the in-process broker in ``local_broker.py``,
+- Postgres is replaced by SQLite through aiosqlite,
+- ``/api/generate`` is driven through httpx's ASGI transport at a fixed rate.
+
+It reports p50/p95/p99 of enqueue latency, queue wait, preprocessing,
+inference and total time, and completed jobs per second:
+
+    pip install -r requirements-bench.txt
+    python benchmark.py --requests 200 --rate 20 --step-ms 20
+
+Worker settings (BATCH_MAX_SIZE, INFERENCE_CONCURRENCY, ...) are read from the
+environment as usual, so configurations can be compared run by run.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Dict, List
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=100, help="Number of generations to submit")
+    parser.add_argument("--rate", type=float, default=10.0, help="Submissions per second")
+    parser.add_argument("--poisson", action="store_true", help="Exponential inter-arrival times instead of a fixed interval")
+    parser.add_argument("--backend", choices=["stub", "tiny"], default="stub")
+    parser.add_argument("--step-ms", type=float, default=20.0, help="Stub latency of one denoising step")
+    parser.add_argument("--batch-cost", type=float, default=0.3,
+                        help="Stub step latency added per extra image in a batch, as a fraction of --step-ms")
+    parser.add_argument("--preprocess-ms", type=float, default=10.0, help="Stub preprocessor latency")
+    parser.add_argument("--size", type=int, default=512, help="Side of the uploaded test images")
+    parser.add_argument("--preset", default="fast")
+    parser.add_argument("--preprocessors", default="canny,pose,depth", help="Preprocessors to cycle through")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Seconds to wait for outstanding jobs")
+    parser.add_argument("--workdir", help="Directory for the database and files (default: a temporary directory)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    return parser.parse_args()
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples: List[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean": statistics.fmean(samples),
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "p99": percentile(samples, 99),
+    }
+
+
+class StubPreprocessor:
+    """Stands in for a controlnet_aux/easy_dwpose detector"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def __call__(self, image, **kwargs):
+        time.sleep(self.latency)
+        return image.convert("L").convert("RGB")
+
+
+class StubPipeline:
+    """Stands in for StableDiffusionControlNetPipeline, sleeping for each step"""
+
+    def __init__(self, step_latency: float, batch_cost: float):
+        self.step_latency = step_latency
+        self.batch_cost = batch_cost
+
+    def __call__(self, prompt, image, num_inference_steps, callback_on_step_end=None, **kwargs):
+        from PIL import Image
+
+        step_latency = self.step_latency * (1 + self.batch_cost * (len(image) - 1))
+        for step in range(num_inference_steps):
+            time.sleep(step_latency)
+            if callback_on_step_end:
+                callback_on_step_end(self, step, step, {})
+        return SimpleNamespace(images=[Image.new("RGB", control.size, (128, 128, 128)) for control in image])
+
+
+def tiny_pipeline():
+    """Randomly initialised ControlNet pipeline small enough to run on a CPU"""
+    import torch
+    from diffusers import (
+        AutoencoderKL,
+        ControlNetModel,
+        DDIMScheduler,
+        StableDiffusionControlNetPipeline,
+        UNet2DConditionModel,
+    )
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+    torch.manual_seed(0)
+    blocks = dict(block_out_channels=(32, 64), layers_per_block=2, cross_attention_dim=32)
+    unet = UNet2DConditionModel(
+        sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        **blocks
+    )
+    controlnet = ControlNetModel(
+        in_channels=4, down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        conditioning_embedding_out_channels=(16, 32), **blocks
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64], in_channels=3, out_channels=3, latent_channels=4,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"]
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0, eos_token_id=2, pad_token_id=1, vocab_size=1000, hidden_size=32,
+        intermediate_size=37, num_attention_heads=4, num_hidden_layers=5, layer_norm_eps=1e-05
+    ))
+    return StableDiffusionControlNetPipeline(
+        unet=unet,
+        controlnet=controlnet,
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip"),
+        scheduler=DDIMScheduler(
+            beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+            clip_sample=False, set_alpha_to_one=False
+        ),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+
+
+class StubPipelineCache:
+    """Replaces worker.pipeline_cache, handing out the benchmark pipeline"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def get(self, key: str, scheduler: str = "default"):
+        return self.pipeline
+
+    def stats(self) -> dict:
+        return {"hits": 0, "misses": 0, "evictions": 0}
+
+    def resident_bytes(self) -> int:
+        return 0
+
+    def offload_bytes(self, key: str) -> int:
+        return 0
+
+    @contextmanager
+    def execution_mode(self, key: str, pipe, mode: str):
+        yield pipe
+
+
+def make_uploads(count: int, size: int) -> List[bytes]:
+    """Distinct PNGs, so neither the upload store nor the control map cache dedupes them"""
+    from PIL import Image, ImageDraw
+
+    uploads = []
+    for index in range(count):
+        image = Image.new("RGB", (size, size), (240, 240, 240))
+        draw = ImageDraw.Draw(image)
+        rng = random.Random(index)
+        for _ in range(8):
+            x, y = rng.randrange(size), rng.randrange(size)
+            draw.rectangle([x, y, x + size // 8, y + size // 8], outline=(0, 0, 0), width=3)
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        uploads.append(buffer.getvalue())
+    return uploads
+
+
+def record_histogram(histogram, samples: Dict[str, List[float]], name: str, **labels):
+    """Copy observations of a labelled prometheus histogram into ``samples[name]``"""
+    child = histogram.labels(**labels)
+    observe = child.observe
+
+    def recording_observe(value):
+        samples.setdefault(name, []).append(value)
+        observe(value)
+    child.observe = recording_observe
+
+
+async def run(args) -> dict:
+    import httpx
+    from sqlalchemy import event
+
+    import local_broker
+    local_broker.install()
+
+    import main
+    import worker
+    from database import engine
+    from generation_config import PRIORITY_CLASSES
+    from metrics import QUEUE_WAIT, STAGE_LATENCY
+
+    # Readers and the writer do not block each other under WAL
+    @event.listens_for(engine.sync_engine, "connect")
+    def enable_wal(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    if args.backend == "stub":
+        pipeline = StubPipeline(args.step_ms / 1000, args.batch_cost)
+    else:
+        pipeline = tiny_pipeline()
+    worker.pipeline_cache = StubPipelineCache(pipeline)
+    for preprocessor in worker.CONTROLNET_MODELS:
+        worker.components.register(
+            f"{preprocessor}_processor",
+            lambda: StubPreprocessor(args.preprocess_ms / 1000)
+        )
+
+    samples: Dict[str, List[float]] = {}
+    record_histogram(STAGE_LATENCY, samples, "preprocess", stage="preprocess")
+    record_histogram(STAGE_LATENCY, samples, "inference", stage="inference")
+    record_histogram(STAGE_LATENCY, samples, "finalize", stage="finalize")
+    for priority_class in PRIORITY_CLASSES:
+        record_histogram(QUEUE_WAIT, samples, "queue_wait", priority=priority_class)
+
+    # Completion times, taken from the events the API process receives
+    finished: Dict[str, float] = {}
+    statuses: Dict[str, str] = {}
+    dispatch = main.event_hub.dispatch
+
+    async def recording_dispatch(event: dict):
+        if event.get("type") == "status" and event.get("status") in ("completed", "error"):
+            finished[event["id"]] = time.perf_counter()
+            statuses[event["id"]] = event["status"]
+        await dispatch(event)
+    main.event_hub.dispatch = recording_dispatch
+
+    await main.startup_event()
+    await worker.consume_queue()
+
+    preprocessors = [p for p in args.preprocessors.split(",") if p]
+    uploads = make_uploads(args.requests, args.size)
+    submitted: Dict[str, float] = {}
+    enqueue_latency: List[float] = []
+    failures: List[str] = []
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        async def submit(index: int):
+            started_at = time.perf_counter()
+            response = await client.post(
+                "/api/generate",
+                files={"image": (f"bench-{index}.png", uploads[index], "image/png")},
+                data={
+                    "prompt": f"benchmark image {index}",
+                    "preprocessor": preprocessors[index % len(preprocessors)],
+                    "preset": args.preset,
+                },
+            )
+            enqueue_latency.append(time.perf_counter() - started_at)
+            if response.status_code != 200:
+                failures.append(f"{response.status_code}: {response.text}")
+                return
+            submitted[response.json()["id"]] = started_at
+
+        print(f"Submitting {args.requests} generations at {args.rate}/s ({args.backend} backend)...")
+        bench_started_at = time.perf_counter()
+        next_at = bench_started_at
+        tasks = []
+        for index in range(args.requests):
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(submit(index)))
+            next_at += random.expovariate(args.rate) if args.poisson else 1 / args.rate
+        await asyncio.gather(*tasks)
+
+        expected = len(submitted)
+        if len(finished) < expected:
+            try:
+                await asyncio.wait_for(wait_for(lambda: len(finished) >= expected), timeout=args.timeout)
+            except asyncio.TimeoutError:
+                print(f"Timed out with {expected - len(finished)} generations outstanding")
+        bench_finished_at = max(finished.values(), default=time.perf_counter())
+
+    total = [finished[generation_id] - started_at for generation_id, started_at in submitted.items()
+             if generation_id in finished]
+    completed = sum(1 for status in statuses.values() if status == "completed")
+    elapsed = bench_finished_at - bench_started_at
+    return {
+        "config": {
+            **vars(args),
+            "batch_max_size": worker.BATCH_MAX_SIZE,
+            "inference_concurrency": worker.INFERENCE_CONCURRENCY,
+            "preprocess_concurrency": worker.PREPROCESS_CONCURRENCY,
+            "prefetch_count": worker.PREFETCH_COUNT,
+        },
+        "submitted": len(submitted),
+        "rejected": len(failures),
+        "completed": completed,
+        "errors": sum(1 for status in statuses.values() if status == "error"),
+        "elapsed_seconds": elapsed,
+        "jobs_per_second": completed / elapsed if elapsed > 0 else 0.0,
+        "latency_seconds": {
+            "enqueue": summarize(enqueue_latency),
+            "queue_wait": summarize(samples.get("queue_wait", [])),
+            "preprocess": summarize(samples.get("preprocess", [])),
+            "inference": summarize(samples.get("inference", [])),
+            "finalize": summarize(samples.get("finalize", [])),
+            "total": summarize(total),
+        },
+        "failures": failures[:10],
+    }
+
+
+async def wait_for(condition, interval: float = 0.05):
+    while not condition():
+        await asyncio.sleep(interval)
+
+
+def print_report(results: dict):
+    print()
+    print(f"{'':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, summary in results["latency_seconds"].items():
+        if not summary["count"]:
+            print(f"{name:<12}{0:>8}")
+            continue
+        print(
+            f"{name:<12}{summary['count']:>8}"
+            f"{summary['p50'] * 1000:>10.1f}{summary['p95'] * 1000:>10.1f}{summary['p99'] * 1000:>10.1f}"
+        )
+    print()
+    print(
+        f"Completed {results['completed']}/{results['submitted']} "
+        f"({results['errors']} errors, {results['rejected']} rejected) in {results['elapsed_seconds']:.1f}s: "
+        f"{results['jobs_per_second']:.2f} jobs/s"
+    )
+    for failure in results["failures"]:
+        print(f"  rejected: {failure}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="sd-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+
+    # Configuration is read at import time, so set it before importing the app
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.environ.setdefault("CONTROL_CACHE_DIR", os.path.join(workdir, "control_cache"))
+    os.environ.setdefault("DERIVATIVE_CACHE_DIR", os.path.join(workdir, "derivatives"))
+    os.environ.setdefault("WORKER_LOAD_MODE", "lazy")
+    # Uploads and outputs are written relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    print(f"Working directory: {workdir}")
+
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from metrics import COMPONENT_LOAD_SECONDS
+
+# Directory holding local model snapshots laid out as <dir>/<org>/<name>.
+# When set, models load from disk only, with no Hugging Face hub resolution.
+MODEL_SNAPSHOT_DIR = os.getenv("MODEL_SNAPSHOT_DIR")
+
+
+def model_location(repo_id: str) -> str:
+    """Local snapshot path for ``repo_id`` when snapshots are configured, else the hub id"""
+    if MODEL_SNAPSHOT_DIR:
+        return os.path.join(MODEL_SNAPSHOT_DIR, repo_id)
+    return repo_id
+
+
+def pretrained_kwargs() -> dict:
+    """Extra ``from_pretrained`` arguments for loading from local safetensors snapshots"""
+    if MODEL_SNAPSHOT_DIR:
+        return {"local_files_only": True, "use_safetensors": True}
+    return {}
+
+
+class ComponentRegistry:
+    """Named model components loaded on first use or eagerly in parallel.
+
+    Each component is loaded at most once, even when requested from several
+    threads at the same time, and its load time is recorded.
+    """
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._components: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self.load_times: Dict[str, float] = {}
+
+    def register(self, name: str, loader: Callable[[], Any]):
+        self._loaders[name] = loader
+        self._locks[name] = threading.Lock()
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._components
+
+    def get(self, name: str) -> Any:
+        component = self._components.get(name)
+        if component is not None:
+            return component
+        if name not in self._loaders:
+            raise KeyError(f"Unknown component: {name}")
+
+        with self._locks[name]:
+            if name not in self._components:
+                print(f"Loading {name}...")
+                started_at = time.perf_counter()
+                self._components[name] = self._loaders[name]()
+                elapsed = time.perf_counter() - started_at
+                self.load_times[name] = elapsed
+                COMPONENT_LOAD_SECONDS.labels(component=name).observe(elapsed)
+                print(f"{name} loaded in {elapsed:.1f}s")
+        return self._components[name]
+
+    def load_all(self, names: Optional[Iterable[str]] = None, max_workers: int = 4) -> Dict[str, float]:
+        """Load components in parallel and return their load times in seconds"""
+        names = list(names if names is not None else self._loaders)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="load") as pool:
+            # list() re-raises the first loading error
+            list(pool.map(self.get, names))
+        return {name: self.load_times[name] for name in names if name in self.load_times}
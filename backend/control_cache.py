@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from PIL import Image
+
+
+class ControlMapCache:
+    """Disk-backed, size-bounded LRU cache of preprocessor control images.
+
+    Entries are PNG files named by their key, so the cache survives worker
+    restarts: on startup the index is rebuilt from the directory, ordered by
+    modification time, which is bumped on every hit.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def make_key(image_sha256: str, preprocessor: str, params: dict) -> str:
+        """Key a control map by input content, preprocessor and its parameters"""
+        payload = json.dumps(
+            {"input": image_sha256, "preprocessor": preprocessor, "params": params},
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with Image.open(path) as cached:
+                    image = cached.copy()
+                os.utime(path)
+            except OSError:
+                # File removed or truncated behind our back
+                self._total_bytes -= self._index.pop(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key: str, image: Image.Image):
+        path = self._path(key)
+        tmp_path = os.path.join(self.directory, f".{uuid.uuid4()}.tmp")
+        image.save(tmp_path, format="PNG")
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if key in self._index:
+                self._total_bytes -= self._index.pop(key)
+            self._index[key] = size
+            self._total_bytes += size
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+            }
+
+    def trim(self, max_bytes: int) -> int:
+        """Evict entries until at most ``max_bytes`` remain, e.g. when the disk runs low, returning the bytes freed"""
+        with self._lock:
+            before = self._total_bytes
+            self._evict(max_bytes)
+            return before - self._total_bytes
+
+    def _evict(self, max_bytes: Optional[int] = None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        while self._index and self._total_bytes > max_bytes:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
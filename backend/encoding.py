@@ -0,0 +1,96 @@
+import os
+from typing import Dict, Optional
+
+from PIL import Image, features
+
+# AVIF needs Pillow built with libavif or the pillow-avif-plugin package
+try:
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# Output formats by name: PIL format, file extension and default quality
+# (None for lossless formats)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "png", None),
+    "webp": ("WEBP", "webp", 90),
+    "jpeg": ("JPEG", "jpg", 90),
+    "avif": ("AVIF", "avif", 70),
+}
+DEFAULT_OUTPUT_FORMAT = os.getenv("DEFAULT_OUTPUT_FORMAT", "png")
+
+# Longest side of the derivatives written next to every output, served to the
+# gallery (thumbnail) and result view (preview) instead of the full image
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "768"))
+DERIVATIVE_FORMAT = "webp"
+DERIVATIVE_QUALITY = int(os.getenv("DERIVATIVE_QUALITY", "80"))
+
+
+def available_formats() -> list:
+    """Output formats the installed Pillow can encode"""
+    available = []
+    for name, (pil_format, _, _) in OUTPUT_FORMATS.items():
+        if pil_format == "AVIF" and not _avif_supported():
+            continue
+        available.append(name)
+    return available
+
+
+def _avif_supported() -> bool:
+    try:
+        return bool(features.check("avif"))
+    except ValueError:
+        # Pillow releases predating the feature flag
+        return "AVIF" in Image.SAVE
+
+
+def encode_image(image: Image.Image, path: str, output_format: str, quality: Optional[int] = None):
+    """Write ``image`` to ``path`` in ``output_format``"""
+    pil_format, _, default_quality = OUTPUT_FORMATS[output_format]
+    options = {}
+    if pil_format == "PNG":
+        options["optimize"] = True
+    else:
+        options["quality"] = quality or default_quality
+    if pil_format == "WEBP":
+        options["method"] = 4
+    if pil_format == "JPEG":
+        options["progressive"] = True
+        image = image.convert("RGB")
+
+    # Write to a temporary name so readers never see a partial file
+    tmp_path = f"{path}.tmp"
+    image.save(tmp_path, format=pil_format, **options)
+    os.replace(tmp_path, path)
+
+
+def resized(image: Image.Image, max_side: int) -> Image.Image:
+    if max(image.size) <= max_side:
+        return image
+    copy = image.copy()
+    copy.thumbnail((max_side, max_side), Image.LANCZOS)
+    return copy
+
+
+def save_outputs(
+    image: Image.Image,
+    directory: str,
+    name: str,
+    output_format: str,
+    quality: Optional[int] = None
+) -> Dict[str, str]:
+    """Encode the output with its preview and thumbnail, returning their paths"""
+    os.makedirs(directory, exist_ok=True)
+    _, extension, _ = OUTPUT_FORMATS[output_format]
+    _, derivative_extension, _ = OUTPUT_FORMATS[DERIVATIVE_FORMAT]
+
+    paths = {
+        "output": os.path.join(directory, f"{name}.{extension}"),
+        "preview": os.path.join(directory, f"{name}_preview.{derivative_extension}"),
+        "thumbnail": os.path.join(directory, f"{name}_thumb.{derivative_extension}"),
+    }
+    encode_image(image, paths["output"], output_format, quality)
+    encode_image(resized(image, PREVIEW_SIZE), paths["preview"], DERIVATIVE_FORMAT, DERIVATIVE_QUALITY)
+    encode_image(resized(image, THUMBNAIL_SIZE), paths["thumbnail"], DERIVATIVE_FORMAT, DERIVATIVE_QUALITY)
+    return paths
@@ -0,0 +1,44 @@
+import asyncio
+import json
+from typing import Dict, Set
+
+# Statuses after which no further events are sent for a generation
+TERMINAL_STATUSES = {"completed", "error", "cancelled", "expired"}
+
+
+class EventHub:
+    """Fan generation events out to in-process subscribers such as SSE streams"""
+
+    def __init__(self, max_queue_size: int = 100):
+        self.max_queue_size = max_queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, generation_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._subscribers.setdefault(generation_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, generation_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(generation_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[generation_id]
+
+    async def dispatch(self, event: dict):
+        for queue in list(self._subscribers.get(event.get("id"), ())):
+            if queue.full():
+                # Slow client: drop the oldest event, later progress supersedes it
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait(event)
+
+
+def format_sse(event_type: str, data: dict) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+event_hub = EventHub()
@@ -0,0 +1,44 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from metrics import EXECUTOR_IN_FLIGHT, EXECUTOR_WAIT, LOOP_LAG
+
+
+class BoundedExecutor:
+    """Thread pool for blocking work with a cap on in-flight submissions.
+
+    Callers beyond ``max_in_flight`` wait on the event loop instead of piling
+    up inside the executor's unbounded work queue.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_in_flight: Optional[int] = None):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(max_in_flight or self.max_workers)
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run ``fn(*args, **kwargs)`` in the pool without blocking the loop"""
+        waited_from = time.monotonic()
+        async with self._slots:
+            EXECUTOR_WAIT.labels(executor=self.name).observe(time.monotonic() - waited_from)
+            EXECUTOR_IN_FLIGHT.labels(executor=self.name).inc()
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+            finally:
+                EXECUTOR_IN_FLIGHT.labels(executor=self.name).dec()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """Record how late the event loop wakes up from a fixed sleep"""
+    while True:
+        started_at = time.monotonic()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.monotonic() - started_at - interval))
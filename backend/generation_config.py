@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+# Models shared by the API (request fingerprints) and the worker (loading)
+BASE_MODEL_ID = os.getenv("SD_BASE_MODEL", "runwayml/stable-diffusion-v1-5")
+CONTROLNET_MODELS = {
+    "canny": "lllyasviel/sd-controlnet-canny",
+    "pose": "lllyasviel/sd-controlnet-openpose",
+    "depth": "lllyasviel/sd-controlnet-depth",
+}
+# ONNX person detector and whole-body pose model of the DWpose preprocessor
+DWPOSE_MODEL_ID = "RedHash/DWPose"
+DWPOSE_DETECTOR_FILE = "yolox_l.onnx"
+DWPOSE_POSE_FILE = "dw-ll_ucoco_384.onnx"
+
+MAX_NUM_INFERENCE_STEPS = 100
+MAX_SEED = 2**31 - 1
+
+
+@dataclass(frozen=True)
+class InferencePreset:
+    """Sampling settings applied to a generation"""
+    scheduler: str  # Key of pipeline_cache.SCHEDULERS
+    num_inference_steps: int
+    guidance_scale: float
+    controlnet_conditioning_scale: float
+    # Longest output side in pixels, None keeps the control image resolution
+    max_resolution: Optional[int] = None
+
+
+PRESETS = {
+    # Previews: UniPC converges in far fewer steps, at a capped resolution
+    "fast": InferencePreset(
+        scheduler="unipc",
+        num_inference_steps=20,
+        guidance_scale=7.5,
+        controlnet_conditioning_scale=1.0,
+        max_resolution=512
+    ),
+    "quality": InferencePreset(
+        scheduler="default",
+        num_inference_steps=50,
+        guidance_scale=7.5,
+        controlnet_conditioning_scale=1.0
+    ),
+}
+DEFAULT_PRESET = os.getenv("DEFAULT_PRESET", "quality")
+
+# Priority classes and their RabbitMQ message priority (task queues use x-max-priority)
+PRIORITY_CLASSES = {
+    "interactive": 9,
+    "standard": 5,
+    "batch": 1,
+}
+DEFAULT_PRIORITY_CLASS = os.getenv("DEFAULT_PRIORITY_CLASS", "standard")
+MAX_TENANT_LENGTH = 64
+DEFAULT_NUM_INFERENCE_STEPS = PRESETS["quality"].num_inference_steps
+
+
+def resolve_preset(name: Optional[str], num_inference_steps: Optional[int] = None) -> InferencePreset:
+    """The named preset (default when unknown or unset) with an optional step override"""
+    preset = PRESETS.get(name or DEFAULT_PRESET, PRESETS[DEFAULT_PRESET])
+    if num_inference_steps:
+        return InferencePreset(**{**asdict(preset), "num_inference_steps": num_inference_steps})
+    return preset
+
+
+def request_fingerprint(
+    input_sha256: str,
+    prompt: str,
+    preprocessor: str,
+    seed: int,
+    preset: InferencePreset,
+    output_format: str,
+    output_quality: Optional[int] = None
+) -> str:
+    """Canonical hash of everything that determines a generation's output"""
+    payload = json.dumps(
+        {
+            "input": input_sha256,
+            "prompt": prompt,
+            "preprocessor": preprocessor,
+            "seed": seed,
+            "preset": asdict(preset),
+            "output": {"format": output_format, "quality": output_quality},
+            "base_model": BASE_MODEL_ID,
+            "controlnet_model": CONTROLNET_MODELS[preprocessor],
+        },
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
@@ -0,0 +1,303 @@
+"""In-process stand-in for the RabbitMQ features used by the API and the worker.
+
+Implements the subset of the aio_pika API that ``rabbitmq.py`` and
+``worker.py`` call: direct, topic and fanout exchanges, durable, exclusive and
+priority queues, per-queue message TTL and dead-lettering, consumers with
+prefetch, basic.get, and ack/reject with requeue. ``install()`` points ``aio_pika.connect_robust`` at a shared broker
+so the API and the worker can run in one process without a RabbitMQ server,
+as the benchmark does.
+"""
+import asyncio
+import heapq
+import itertools
+import uuid
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+import aio_pika
+from aio_pika.exceptions import ChannelNotFoundEntity, QueueEmpty
+
+
+def _exchange_type(exchange_type) -> str:
+    return getattr(exchange_type, "value", exchange_type)
+
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """AMQP topic matching: ``*`` is exactly one word, ``#`` zero or more"""
+    def match(pattern_words: List[str], key_words: List[str]) -> bool:
+        if not pattern_words:
+            return not key_words
+        head, rest = pattern_words[0], pattern_words[1:]
+        if head == "#":
+            return any(match(rest, key_words[i:]) for i in range(len(key_words) + 1))
+        if not key_words:
+            return False
+        return (head == "*" or head == key_words[0]) and match(rest, key_words[1:])
+    return match(pattern.split("."), routing_key.split("."))
+
+
+class LocalIncomingMessage:
+    """A delivered message, mirroring aio_pika.IncomingMessage"""
+
+    def __init__(self, queue: "LocalQueue", message: aio_pika.Message, routing_key: str, exchange: str,
+                 redelivered: bool, channel: Optional["LocalChannel"], no_ack: bool, sequence: int):
+        self._queue = queue
+        self._message = message
+        self._sequence = sequence
+        self._channel = channel
+        self.body = message.body
+        self.headers = dict(message.headers or {})
+        self.priority = message.priority
+        self.content_type = message.content_type
+        self.delivery_mode = message.delivery_mode
+        self.routing_key = routing_key
+        self.exchange = exchange
+        self.redelivered = redelivered
+        self.processed = no_ack
+
+    async def ack(self):
+        self._settle()
+
+    async def reject(self, requeue: bool = False):
+        if requeue:
+            # Back to its place in the queue before the freed prefetch slot is refilled
+            self._queue.put(self._message, self.routing_key, self.exchange, redelivered=True, sequence=self._sequence)
+        else:
+            self._queue.dead_letter(self._message, self.routing_key)
+        self._settle()
+
+    async def nack(self, requeue: bool = True):
+        await self.reject(requeue=requeue)
+
+    def _settle(self):
+        if self.processed:
+            raise RuntimeError("Message already processed")
+        self.processed = True
+        if self._channel is not None:
+            self._channel.unacked -= 1
+            self._queue.broker.dispatch_all()
+
+    @asynccontextmanager
+    async def process(self, requeue: bool = False, reject_on_redelivered: bool = False, ignore_processed: bool = False):
+        try:
+            yield self
+        except BaseException:
+            if not (ignore_processed and self.processed):
+                await self.reject(requeue=requeue)
+            raise
+        else:
+            if not (ignore_processed and self.processed):
+                await self.ack()
+
+
+class LocalExchange:
+    def __init__(self, broker: "LocalBroker", name: str, exchange_type: str):
+        self.broker = broker
+        self.name = name
+        self.type = exchange_type
+        # (queue, routing key) pairs
+        self.bindings: List[tuple] = []
+
+    async def publish(self, message: aio_pika.Message, routing_key: str, **kwargs):
+        self.broker.route(self, message, routing_key)
+
+
+class LocalQueue:
+    def __init__(self, broker: "LocalBroker", name: str, arguments: Optional[dict] = None,
+                 exclusive_to: Optional["LocalChannel"] = None):
+        self.broker = broker
+        self.name = name
+        self.arguments = arguments or {}
+        self.exclusive_to = exclusive_to
+        self.max_priority = int(self.arguments.get("x-max-priority", 0))
+        self.message_ttl = self.arguments.get("x-message-ttl")
+        self.dead_letter_exchange = self.arguments.get("x-dead-letter-exchange")
+        self.dead_letter_routing_key = self.arguments.get("x-dead-letter-routing-key")
+        self._messages: List[tuple] = []
+        # Expiry time of queued messages by sequence, with a message TTL
+        self._expires_at: Dict[int, float] = {}
+        self._sequence = itertools.count()
+        # (callback, channel, no_ack) of each consumer, served round-robin
+        self.consumers: List[tuple] = []
+        self._next_consumer = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, message: aio_pika.Message, routing_key: str, exchange: str, redelivered: bool = False,
+            sequence: Optional[int] = None):
+        priority = min(message.priority or 0, self.max_priority) if self.max_priority else 0
+        # Requeued messages keep their sequence, so they return to their place
+        if sequence is None:
+            sequence = next(self._sequence)
+            if self.message_ttl is not None:
+                loop = asyncio.get_running_loop()
+                self._expires_at[sequence] = loop.time() + self.message_ttl / 1000
+                loop.call_later(self.message_ttl / 1000, self.expire)
+        heapq.heappush(self._messages, (-priority, sequence, message, routing_key, exchange, redelivered))
+        self.broker.dispatch_all()
+
+    def _pop(self):
+        _, sequence, message, routing_key, exchange, redelivered = heapq.heappop(self._messages)
+        self._expires_at.pop(sequence, None)
+        return message, routing_key, exchange, redelivered, sequence
+
+    def expire(self):
+        """Dead-letter the messages at the head of the queue whose TTL has passed"""
+        now = asyncio.get_running_loop().time()
+        while self._messages and self._expires_at.get(self._messages[0][1], now + 1) <= now:
+            message, routing_key, _, _, _ = self._pop()
+            self.dead_letter(message, routing_key)
+
+    def dead_letter(self, message: aio_pika.Message, routing_key: str):
+        exchange = self.broker.exchanges.get(self.dead_letter_exchange) if self.dead_letter_exchange is not None else None
+        if exchange is not None:
+            self.broker.route(exchange, message, self.dead_letter_routing_key or routing_key)
+
+    def dispatch(self):
+        while self._messages and self.consumers:
+            for offset in range(len(self.consumers)):
+                index = (self._next_consumer + offset) % len(self.consumers)
+                callback, channel, no_ack = self.consumers[index]
+                if no_ack or channel.has_capacity():
+                    break
+            else:
+                # Every consumer is at its prefetch limit
+                return
+            self._next_consumer = index + 1
+            message, routing_key, exchange, redelivered, sequence = self._pop()
+            if not no_ack:
+                channel.unacked += 1
+            incoming = LocalIncomingMessage(
+                self, message, routing_key, exchange, redelivered, None if no_ack else channel, no_ack, sequence
+            )
+            asyncio.get_running_loop().create_task(callback(incoming))
+
+
+class LocalQueueHandle:
+    """A queue as seen from one channel, like aio_pika.Queue"""
+
+    def __init__(self, queue: LocalQueue, channel: "LocalChannel"):
+        self.queue = queue
+        self.channel = channel
+        self.name = queue.name
+        self.arguments = queue.arguments
+        self.declaration_result = SimpleNamespace(
+            message_count=len(queue), consumer_count=len(queue.consumers)
+        )
+
+    async def bind(self, exchange, routing_key: str = "", **kwargs):
+        exchange = self.queue.broker.exchanges[exchange if isinstance(exchange, str) else exchange.name]
+        if (self.queue, routing_key) not in exchange.bindings:
+            exchange.bindings.append((self.queue, routing_key))
+
+    async def consume(self, callback: Callable, no_ack: bool = False, **kwargs) -> str:
+        self.queue.consumers.append((callback, self.channel, no_ack))
+        self.queue.broker.dispatch_all()
+        return f"ctag-{uuid.uuid4().hex}"
+
+    async def get(self, no_ack: bool = False, fail: bool = True, timeout: Any = None):
+        if not len(self.queue):
+            if fail:
+                raise QueueEmpty()
+            return None
+        message, routing_key, exchange, redelivered, sequence = self.queue._pop()
+        return LocalIncomingMessage(self.queue, message, routing_key, exchange, redelivered, None, no_ack, sequence)
+
+
+class LocalChannel:
+    def __init__(self, broker: "LocalBroker"):
+        self.broker = broker
+        self.prefetch_count = 0
+        self.unacked = 0
+        self.default_exchange = broker.exchanges[""]
+
+    def has_capacity(self) -> bool:
+        return not self.prefetch_count or self.unacked < self.prefetch_count
+
+    async def set_qos(self, prefetch_count: int = 0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    async def declare_exchange(self, name: str, type=aio_pika.ExchangeType.DIRECT, **kwargs) -> LocalExchange:
+        exchange = self.broker.exchanges.get(name)
+        if exchange is None:
+            exchange = self.broker.exchanges[name] = LocalExchange(self.broker, name, _exchange_type(type))
+        return exchange
+
+    async def get_exchange(self, name: str, **kwargs) -> LocalExchange:
+        return self.broker.exchanges[name]
+
+    async def declare_queue(self, name: Optional[str] = None, durable: bool = False, exclusive: bool = False,
+                            auto_delete: bool = False, arguments: Optional[dict] = None, passive: bool = False,
+                            **kwargs) -> LocalQueueHandle:
+        name = name or f"amq.gen-{uuid.uuid4().hex}"
+        queue = self.broker.queues.get(name)
+        if queue is None and passive:
+            raise ChannelNotFoundEntity(f"NOT_FOUND - no queue '{name}'")
+        if queue is None:
+            queue = self.broker.queues[name] = LocalQueue(
+                self.broker, name, arguments, exclusive_to=self if exclusive else None
+            )
+        return LocalQueueHandle(queue, self)
+
+    async def close(self):
+        for queue in list(self.broker.queues.values()):
+            queue.consumers = [consumer for consumer in queue.consumers if consumer[1] is not self]
+            if queue.exclusive_to is self:
+                del self.broker.queues[queue.name]
+
+
+class LocalConnection:
+    def __init__(self, broker: "LocalBroker"):
+        self.broker = broker
+        self.channels: List[LocalChannel] = []
+
+    async def channel(self, **kwargs) -> LocalChannel:
+        channel = LocalChannel(self.broker)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+
+
+class LocalBroker:
+    """Exchanges, queues and routing shared by every local connection"""
+
+    def __init__(self):
+        self.exchanges: Dict[str, LocalExchange] = {"": LocalExchange(self, "", "direct")}
+        self.queues: Dict[str, LocalQueue] = {}
+
+    def route(self, exchange: LocalExchange, message: aio_pika.Message, routing_key: str):
+        if exchange.name == "":
+            queue = self.queues.get(routing_key)
+            targets = [queue] if queue is not None else []
+        elif exchange.type == "fanout":
+            targets = [queue for queue, _ in exchange.bindings]
+        elif exchange.type == "topic":
+            targets = [queue for queue, pattern in exchange.bindings if topic_matches(pattern, routing_key)]
+        else:
+            targets = [queue for queue, key in exchange.bindings if key == routing_key]
+        # Unroutable messages are dropped, as RabbitMQ does without mandatory
+        for queue in dict.fromkeys(targets):
+            if queue.name in self.queues:
+                queue.put(message, routing_key, exchange.name)
+
+    def dispatch_all(self):
+        for queue in list(self.queues.values()):
+            queue.dispatch()
+
+
+broker = LocalBroker()
+
+
+async def connect_robust(*args, **kwargs) -> LocalConnection:
+    return LocalConnection(broker)
+
+
+def install():
+    """Route aio_pika connections made after this call to the in-process broker"""
+    aio_pika.connect_robust = connect_robust
+    aio_pika.connect = connect_robust
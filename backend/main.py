@@ -1,22 +1,44 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Depends
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Depends, Request, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
-from typing import Optional, AsyncGenerator
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Optional, List
+import asyncio
+import base64
+import secrets
+import time
+from dataclasses import asdict
 import os
 import uuid
 import aio_pika
 import json
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
-from sqlalchemy.sql import text
+from sqlalchemy.sql import text, bindparam
+from sqlalchemy.exc import IntegrityError
 
-from models import Base, Generation
-from database import get_db, init_db
-from rabbitmq import init_rabbitmq, publish_message, close_rabbitmq
+from models import Generation, OutboxMessage
+from database import get_db, init_db, async_session
+from rabbitmq import init_rabbitmq, publish_event, close_rabbitmq, consume_events, dead_letters, copy_task_message, ATTEMPT_HEADER
+from outbox import outbox_relay, outbox_message
+from generation_config import request_fingerprint, resolve_preset, PRESETS, DEFAULT_PRESET, MAX_NUM_INFERENCE_STEPS, MAX_SEED, PRIORITY_CLASSES, DEFAULT_PRIORITY_CLASS, MAX_TENANT_LENGTH
+from events import event_hub, format_sse, TERMINAL_STATUSES
+from storage import save_upload, read_image_size, UploadTooLarge, UploadLimitMiddleware
+from memory_planner import InputTooLarge, admit_input
+from PIL import Image, UnidentifiedImageError
+from starlette.concurrency import run_in_threadpool
+from encoding import available_formats, DEFAULT_OUTPUT_FORMAT
+from metrics import DB_WRITE_SECONDS, REQUEST_SECONDS, GENERATIONS_BY_STATUS, OLDEST_QUEUED_AGE, OUTBOX_BACKLOG
+from tracing import new_trace, parse_traceparent, span
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from static_files import ImmutableStaticFiles, DerivativeCache, DERIVATIVE_CACHE_DIR, DERIVATIVE_CACHE_MAX_MB
+from retention import RetentionService, record_files
 
 app = FastAPI(title="Stable Diffusion ControlNet API")
 
+# Reject oversized uploads from Content-Length before the body is parsed
+app.add_middleware(UploadLimitMiddleware, paths=("/api/generate",))
+
 # CORS configuration
 app.add_middleware(
     CORSMiddleware,
@@ -24,75 +46,500 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template, not by path, to keep the number of series bounded
+        route = request.scope.get("route")
+        REQUEST_SECONDS.labels(
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=str(status)
+        ).observe(time.perf_counter() - started_at)
+
 # Create directory for uploaded and generated images
 os.makedirs("./uploads", exist_ok=True)
 os.makedirs("./generations", exist_ok=True)
 
-# Mount static files
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-app.mount("/generations", StaticFiles(directory="generations"), name="generations")
+# Mount static files, served with long-lived caching since they are never rewritten
+derivative_cache = DerivativeCache(DERIVATIVE_CACHE_DIR, DERIVATIVE_CACHE_MAX_MB * 1024**2)
+retention = RetentionService(derivatives=derivative_cache)
+app.mount("/uploads", ImmutableStaticFiles(directory="uploads"), name="uploads")
+app.mount(
+    "/generations",
+    ImmutableStaticFiles(directory="generations", derivatives=derivative_cache),
+    name="generations"
+)
 
 @app.on_event("startup")
 async def startup_event():
     await init_db()
     await init_rabbitmq()
+    await consume_events(event_hub.dispatch, "status", "progress")
+    # Publishes tasks committed before a restart too
+    outbox_relay.start()
+    retention.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await retention.stop()
+    await outbox_relay.stop()
     await close_rabbitmq()
 
+# Base of the file URLs returned to clients, e.g. a CDN in front of the static mounts
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:8000").rstrip("/")
+
+# Columns needed to serialize a generation in API responses
+GENERATION_COLUMNS = (
+    "id, status, prompt, preprocessor, created_at, output_image_path, preview_image_path, thumbnail_image_path, "
+    "error_message, seed, preset, num_inference_steps, output_format, output_quality, priority, tenant, trace_id"
+)
+MAX_PAGE_SIZE = 100
+# Generations accepted in one bulk submission, and the longest Idempotency-Key
+MAX_BATCH_SUBMISSIONS = int(os.getenv("MAX_BATCH_SUBMISSIONS", "100"))
+MAX_IDEMPOTENCY_KEY_LENGTH = 200
+
+# Token expected in the X-Admin-Token header of admin endpoints, which are
+# disabled when it is not set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def encode_cursor(created_at: datetime, generation_id: str) -> str:
+    raw = f"{created_at.isoformat()}|{generation_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, generation_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), generation_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def result_url(output_image_path: str) -> str:
+    return f"{PUBLIC_BASE_URL}/{output_image_path}"
+
+def serialize_generation(generation) -> dict:
+    response = {
+        "id": generation.id,
+        "status": generation.status,
+        "prompt": generation.prompt,
+        "preprocessor": generation.preprocessor,
+        "created_at": generation.created_at.isoformat(),
+        "seed": generation.seed,
+        "preset": generation.preset,
+        "num_inference_steps": generation.num_inference_steps,
+        "output_format": generation.output_format,
+        "output_quality": generation.output_quality,
+        "priority": generation.priority,
+        "tenant": generation.tenant,
+        "trace_id": generation.trace_id
+    }
+    
+    # Add result URL if generation is completed
+    if generation.status == "completed" and generation.output_image_path:
+        response["resultUrl"] = result_url(generation.output_image_path)
+        if generation.preview_image_path:
+            response["previewUrl"] = result_url(generation.preview_image_path)
+        if generation.thumbnail_image_path:
+            response["thumbnailUrl"] = result_url(generation.thumbnail_image_path)
+    
+    # Add error message if generation failed
+    if generation.status == "error":
+        response["error"] = generation.error_message
+    
+    return response
+
+async def find_reusable_generation(db: AsyncSession, fingerprint: str):
+    """A completed or in-flight generation with the same fingerprint, completed first"""
+    result = await db.execute(
+        text(f"""
+        SELECT {GENERATION_COLUMNS} FROM generations
+        WHERE fingerprint = :fingerprint AND status IN ('completed', 'queued', 'processing')
+        ORDER BY CASE WHEN status = 'completed' THEN 0 ELSE 1 END, created_at DESC
+        LIMIT 1
+        """),
+        {"fingerprint": fingerprint}
+    )
+    return result.fetchone()
+
+def reused_generation(generation) -> dict:
+    response = serialize_generation(generation)
+    if generation.status == "completed":
+        response["message"] = "Identical generation already completed"
+    else:
+        response["message"] = "Identical generation already queued"
+    return response
+
+def reused_generation_response(generation) -> JSONResponse:
+    return JSONResponse(reused_generation(generation))
+
+@app.get("/metrics")
+async def metrics(db: AsyncSession = Depends(get_db)):
+    # Backlog gauges are computed from the database on each scrape
+    result = await db.execute(text("""
+        SELECT status, COUNT(*) AS count FROM generations
+        WHERE status IN ('queued', 'processing')
+        GROUP BY status
+    """))
+    counts = {row.status: row.count for row in result}
+    for status in ("queued", "processing"):
+        GENERATIONS_BY_STATUS.labels(status=status).set(counts.get(status, 0))
+    
+    result = await db.execute(text("SELECT MIN(created_at) FROM generations WHERE status = 'queued'"))
+    oldest = result.scalar()
+    OLDEST_QUEUED_AGE.set((datetime.now() - oldest).total_seconds() if oldest else 0)
+    
+    result = await db.execute(text("SELECT COUNT(*) FROM task_outbox"))
+    OUTBOX_BACKLOG.set(result.scalar())
+    
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/api/presets")
+async def list_presets():
+    return {
+        "default": DEFAULT_PRESET,
+        "presets": {name: asdict(preset) for name, preset in PRESETS.items()},
+        "output_formats": available_formats(),
+        "default_output_format": DEFAULT_OUTPUT_FORMAT
+    }
+
+class GenerationRequest(BaseModel):
+    """Parameters of one generation; in bulk submissions ``image`` indexes the uploaded images"""
+    image: int = 0
+    prompt: str
+    preprocessor: str
+    seed: Optional[int] = None
+    preset: str = DEFAULT_PRESET
+    num_inference_steps: Optional[int] = None
+    priority: str = DEFAULT_PRIORITY_CLASS
+    tenant: Optional[str] = None
+    output_format: str = DEFAULT_OUTPUT_FORMAT
+    output_quality: Optional[int] = None
+
+def validate_generation_request(params: GenerationRequest):
+    if params.preprocessor not in ["canny", "pose", "depth"]:
+        raise HTTPException(status_code=400, detail="Invalid preprocessor type")
+    if params.preset not in PRESETS:
+        raise HTTPException(status_code=400, detail=f"Invalid preset, expected one of {sorted(PRESETS)}")
+    if params.num_inference_steps is not None and not 1 <= params.num_inference_steps <= MAX_NUM_INFERENCE_STEPS:
+        raise HTTPException(status_code=400, detail=f"num_inference_steps must be between 1 and {MAX_NUM_INFERENCE_STEPS}")
+    if params.seed is not None and not 0 <= params.seed <= MAX_SEED:
+        raise HTTPException(status_code=400, detail=f"seed must be between 0 and {MAX_SEED}")
+    if params.priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority, expected one of {sorted(PRIORITY_CLASSES)}")
+    if params.tenant is not None and not 0 < len(params.tenant) <= MAX_TENANT_LENGTH:
+        raise HTTPException(status_code=400, detail=f"tenant must be 1 to {MAX_TENANT_LENGTH} characters")
+    if params.output_format not in available_formats():
+        raise HTTPException(status_code=400, detail=f"Invalid output_format, expected one of {available_formats()}")
+    if params.output_quality is not None and not 1 <= params.output_quality <= 100:
+        raise HTTPException(status_code=400, detail="output_quality must be between 1 and 100")
+
+def build_generation(
+    params: GenerationRequest,
+    image_path: str,
+    input_sha256: str,
+    trace,
+    idempotency_key: Optional[str] = None
+):
+    """The generation row for a validated request and the outbox message queueing its task"""
+    # Without an explicit seed the output is not reproducible, so pick one and
+    # record it; only requests that pin the seed can match an earlier result
+    seed = params.seed if params.seed is not None else secrets.randbelow(MAX_SEED + 1)
+    settings = resolve_preset(params.preset, params.num_inference_steps)
+    generation = Generation(
+        id=str(uuid.uuid4()),
+        prompt=params.prompt,
+        preprocessor=params.preprocessor,
+        input_image_path=image_path,
+        status="queued",
+        created_at=datetime.now(),
+        input_sha256=input_sha256,
+        seed=seed,
+        preset=params.preset,
+        num_inference_steps=settings.num_inference_steps,
+        output_format=params.output_format,
+        output_quality=params.output_quality,
+        fingerprint=request_fingerprint(
+            input_sha256, params.prompt, params.preprocessor, seed, settings,
+            params.output_format, params.output_quality
+        ),
+        priority=params.priority,
+        tenant=params.tenant,
+        trace_id=trace.trace_id,
+        idempotency_key=idempotency_key
+    )
+    task = {
+        "id": generation.id,
+        "prompt": params.prompt,
+        "preprocessor": params.preprocessor,
+        "image_path": image_path,
+        "seed": seed,
+        "preset": params.preset,
+        "num_inference_steps": settings.num_inference_steps,
+        "output_format": params.output_format,
+        "output_quality": params.output_quality,
+        "priority": params.priority,
+        "tenant": params.tenant,
+        "queued_at": time.time()
+    }
+    # The trace context travels to the worker in the message headers
+    message = outbox_message(
+        generation.id, params.preprocessor, PRIORITY_CLASSES[params.priority], task,
+        headers={"traceparent": trace.traceparent}
+    )
+    return generation, message
+
+async def store_uploads(db: AsyncSession, images: List[UploadFile]) -> list:
+    """Save uploads to their content-addressed files and index them, returning (path, sha256) of each"""
+    uploads = [await save_upload(image) for image in images]
+    # Indexed right away, so retention can delete them if no generation ends up using them
+    await record_files(db, "upload", {path for path, _ in uploads})
+    # An identical file removed as an orphan before the index rows were bumped
+    # is written again; retention leaves it alone while this transaction holds them
+    for index, (image_path, _) in enumerate(uploads):
+        if not await run_in_threadpool(os.path.exists, image_path):
+            await images[index].seek(0)
+            uploads[index] = await save_upload(images[index])
+            await record_files(db, "upload", [image_path])
+    await db.commit()
+    return uploads
+
+async def admit_upload(image_path: str):
+    """Reject uploads the worker would refuse, before a task is queued for them"""
+    try:
+        width, height = await run_in_threadpool(read_image_size, image_path)
+        admit_input(width, height)
+    except (InputTooLarge, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a supported image")
+
+def request_trace(request: Request):
+    # Continue the caller's trace when it sent one, the worker spans join it
+    incoming_trace = parse_traceparent(request.headers.get("traceparent"))
+    return incoming_trace.child() if incoming_trace else new_trace()
+
+async def find_idempotent_generations(db: AsyncSession, keys: List[str]) -> dict:
+    """Generations created with the given idempotency keys, by key"""
+    result = await db.execute(
+        text(f"SELECT {GENERATION_COLUMNS}, idempotency_key, input_sha256 FROM generations WHERE idempotency_key IN :keys")
+        .bindparams(bindparam("keys", expanding=True)),
+        {"keys": keys}
+    )
+    return {row.idempotency_key: row for row in result.fetchall()}
+
+def idempotent_response(existing, generation: Generation, params: GenerationRequest) -> dict:
+    """The earlier generation a retried request refers to, if the request is the same one"""
+    same_request = (
+        existing.input_sha256 == generation.input_sha256
+        and existing.prompt == generation.prompt
+        and existing.preprocessor == generation.preprocessor
+        and existing.preset == generation.preset
+        and existing.num_inference_steps == generation.num_inference_steps
+        and existing.output_format == generation.output_format
+        and existing.output_quality == generation.output_quality
+        and existing.priority == generation.priority
+        # A seed chosen by the server is whatever the first attempt drew
+        and (params.seed is None or existing.seed == params.seed)
+    )
+    if not same_request:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    response = serialize_generation(existing)
+    response["message"] = "Generation already submitted with this Idempotency-Key"
+    return response
+
+def queued_response(generation: Generation) -> dict:
+    return {
+        "id": generation.id,
+        "status": "queued",
+        "seed": generation.seed,
+        "trace_id": generation.trace_id,
+        "message": "Generation task queued successfully"
+    }
+
 @app.post("/api/generate")
 async def generate_image(
+    request: Request,
     background_tasks: BackgroundTasks,
     image: UploadFile = File(...),
     prompt: str = Form(...),
     preprocessor: str = Form(...),
+    seed: Optional[int] = Form(None),
+    preset: str = Form(DEFAULT_PRESET),
+    num_inference_steps: Optional[int] = Form(None),
+    priority: str = Form(DEFAULT_PRIORITY_CLASS),
+    tenant: Optional[str] = Form(None),
+    output_format: str = Form(DEFAULT_OUTPUT_FORMAT),
+    output_quality: Optional[int] = Form(None),
+    idempotency_key: Optional[str] = Header(None, max_length=MAX_IDEMPOTENCY_KEY_LENGTH),
     db: AsyncSession = Depends(get_db)
 ):
-    # Validate preprocessor
-    if preprocessor not in ["canny", "pose", "depth"]:
-        raise HTTPException(status_code=400, detail="Invalid preprocessor type")
-    
-    # Generate unique ID for this generation
-    generation_id = str(uuid.uuid4())
-    
-    # Save uploaded image
-    image_path = f"uploads/{generation_id}.png"
-    with open(image_path, "wb") as buffer:
-        buffer.write(await image.read())
-    
-    # Create new generation record in database
-    new_generation = Generation(
-        id=generation_id,
+    params = GenerationRequest(
         prompt=prompt,
         preprocessor=preprocessor,
-        input_image_path=image_path,
-        status="processing",
-        created_at=datetime.now()
+        seed=seed,
+        preset=preset,
+        num_inference_steps=num_inference_steps,
+        priority=priority,
+        tenant=tenant,
+        output_format=output_format,
+        output_quality=output_quality
     )
+    validate_generation_request(params)
+    # Without a tenant key, each client address gets its own fair share
+    if params.tenant is None:
+        params.tenant = request.client.host if request.client else "anonymous"
+    trace = request_trace(request)
     
-    db.add(new_generation)
-    await db.commit()
+    # Stream uploaded image to a content-addressed file, shared by identical uploads
+    try:
+        with span("api.save_upload", trace):
+            [(image_path, input_sha256)] = await store_uploads(db, [image])
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    await admit_upload(image_path)
     
-    # Add task to RabbitMQ queue
-    task = {
-        "id": generation_id,
-        "prompt": prompt,
-        "preprocessor": preprocessor,
-        "image_path": image_path
-    }
+    generation, message = build_generation(params, image_path, input_sha256, trace, idempotency_key)
     
-    # Publish message to RabbitMQ
-    await publish_message(json.dumps(task))
+    # A retry of an earlier request returns what that request created
+    if idempotency_key:
+        existing = (await find_idempotent_generations(db, [idempotency_key])).get(idempotency_key)
+        if existing:
+            return JSONResponse(idempotent_response(existing, generation, params), headers={"Idempotent-Replayed": "true"})
+    
+    existing = await find_reusable_generation(db, generation.fingerprint)
+    if existing:
+        return reused_generation_response(existing)
+    
+    # The task message is committed with the generation and published by the relay
+    db.add_all([generation, message])
+    try:
+        with span("api.db_insert", trace, generation_id=generation.id), \
+                DB_WRITE_SECONDS.labels(operation="insert").time():
+            await db.commit()
+    except IntegrityError:
+        # A concurrent retry with the same key, or an identical request, queued
+        # the same job first: join it
+        await db.rollback()
+        if idempotency_key:
+            existing = (await find_idempotent_generations(db, [idempotency_key])).get(idempotency_key)
+            if existing:
+                return JSONResponse(idempotent_response(existing, generation, params), headers={"Idempotent-Replayed": "true"})
+        existing = await find_reusable_generation(db, generation.fingerprint)
+        if not existing:
+            raise
+        return reused_generation_response(existing)
+    outbox_relay.notify()
     
     # Return response with generation ID
-    return JSONResponse({
-        "id": generation_id,
-        "status": "processing",
-        "message": "Generation task queued successfully"
-    })
+    return JSONResponse(queued_response(generation))
+
+@app.post("/api/generate/batch")
+async def generate_batch(
+    request: Request,
+    images: List[UploadFile] = File(...),
+    generations: str = Form(..., description="JSON list of generation requests"),
+    idempotency_key: Optional[str] = Header(None, max_length=MAX_IDEMPOTENCY_KEY_LENGTH),
+    db: AsyncSession = Depends(get_db)
+):
+    """Queue many generations in one request and one transaction.
+
+    ``generations`` is a JSON list of objects with the fields of /api/generate,
+    where ``image`` is the index of the upload to use. Responses come back in
+    the same order. With an Idempotency-Key, item ``i`` is keyed ``<key>:<i>``,
+    so retrying the whole request is safe.
+    """
+    try:
+        items = [GenerationRequest(**item) for item in json.loads(generations)]
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid generations: {str(e)}")
+    if not 0 < len(items) <= MAX_BATCH_SUBMISSIONS:
+        raise HTTPException(status_code=400, detail=f"Submit 1 to {MAX_BATCH_SUBMISSIONS} generations")
+    for index, params in enumerate(items):
+        try:
+            validate_generation_request(params)
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"generations[{index}]: {e.detail}")
+        if not 0 <= params.image < len(images):
+            raise HTTPException(status_code=400, detail=f"generations[{index}]: image must index one of the {len(images)} uploads")
+        if params.tenant is None:
+            params.tenant = request.client.host if request.client else "anonymous"
+    trace = request_trace(request)
+    
+    try:
+        with span("api.save_upload", trace, count=len(images)):
+            uploads = await store_uploads(db, images)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    for index, (image_path, _) in enumerate(uploads):
+        try:
+            await admit_upload(image_path)
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"images[{index}]: {e.detail}")
+    
+    built = [
+        build_generation(
+            params, *uploads[params.image], trace,
+            f"{idempotency_key}:{index}" if idempotency_key else None
+        )
+        for index, params in enumerate(items)
+    ]
+    
+    keyed = {}
+    if idempotency_key:
+        keyed = await find_idempotent_generations(db, [generation.idempotency_key for generation, _ in built])
+    result = await db.execute(
+        text(f"""
+        SELECT {GENERATION_COLUMNS}, fingerprint FROM generations
+        WHERE fingerprint IN :fingerprints AND status IN ('completed', 'queued', 'processing')
+        ORDER BY CASE WHEN status = 'completed' THEN 0 ELSE 1 END, created_at DESC
+        """).bindparams(bindparam("fingerprints", expanding=True)),
+        {"fingerprints": [generation.fingerprint for generation, _ in built]}
+    )
+    reusable = {}
+    for row in result.fetchall():
+        reusable.setdefault(row.fingerprint, row)
+    
+    responses, new_rows = [], []
+    # Identical items within the batch share one job
+    queued = {}
+    for params, (generation, message) in zip(items, built):
+        existing = keyed.get(generation.idempotency_key)
+        if existing:
+            responses.append(idempotent_response(existing, generation, params))
+        elif generation.fingerprint in reusable:
+            responses.append(reused_generation(reusable[generation.fingerprint]))
+        elif generation.fingerprint in queued:
+            responses.append(queued_response(queued[generation.fingerprint]))
+        else:
+            queued[generation.fingerprint] = generation
+            new_rows += [generation, message]
+            responses.append(queued_response(generation))
+    
+    if new_rows:
+        db.add_all(new_rows)
+        try:
+            with span("api.db_insert", trace, count=len(queued)), \
+                    DB_WRITE_SECONDS.labels(operation="insert_batch").time():
+                await db.commit()
+        except IntegrityError:
+            # Nothing was inserted; a retry with the same key resolves the conflict
+            await db.rollback()
+            raise HTTPException(
+                status_code=409,
+                detail="A concurrent submission queued some of these generations, retry the request"
+            )
+        outbox_relay.notify()
+    
+    return responses
 
 @app.get("/api/generations/{generation_id}")
 async def get_generation_status(
@@ -105,7 +552,7 @@ async def get_generation_status(
     #     {"id": generation_id}
     # )
     result = await db.execute(
-        text("SELECT * FROM generations WHERE id = :id"),
+        text(f"SELECT {GENERATION_COLUMNS} FROM generations WHERE id = :id"),
         {"id": generation_id}
     )
     generation = result.fetchone()
@@ -113,52 +560,285 @@ async def get_generation_status(
     if not generation:
         raise HTTPException(status_code=404, detail="Generation not found")
     
-    response = {
-        "id": generation.id,
-        "status": generation.status,
-        "prompt": generation.prompt,
-        "preprocessor": generation.preprocessor,
-        "created_at": generation.created_at.isoformat()
+    return serialize_generation(generation)
+
+async def publish_event_quietly(generation_id: str, event: dict):
+    """Best-effort publish of an event about a change already committed"""
+    try:
+        await publish_event(generation_id, event)
+    except Exception as e:
+        print(f"Error publishing {event['type']} event for {generation_id}: {str(e)}")
+
+@app.delete("/api/generations/{generation_id}")
+async def cancel_generation(
+    generation_id: str,
+    db: AsyncSession = Depends(get_db)
+):
+    # Only queued or running generations can be cancelled
+    with DB_WRITE_SECONDS.labels(operation="cancel").time():
+        result = await db.execute(
+            text("""
+            UPDATE generations 
+            SET status = 'cancelled' 
+            WHERE id = :id AND status IN ('queued', 'processing')
+            RETURNING id
+            """),
+            {"id": generation_id}
+        )
+        cancelled = result.fetchone()
+        await db.commit()
+    
+    if not cancelled:
+        result = await db.execute(
+            text("SELECT status FROM generations WHERE id = :id"),
+            {"id": generation_id}
+        )
+        generation = result.fetchone()
+        if not generation:
+            raise HTTPException(status_code=404, detail="Generation not found")
+        raise HTTPException(
+            status_code=409,
+            detail=f"Generation cannot be cancelled (status: {generation.status})"
+        )
+    
+    # Workers abort the job if it is already in flight. Without the event a
+    # worker still finishes it, but then finds the row cancelled and drops the output
+    await publish_event_quietly(generation_id, {"type": "cancel", "id": generation_id})
+    await publish_event_quietly(generation_id, {"type": "status", "id": generation_id, "status": "cancelled"})
+    
+    return {
+        "id": generation_id,
+        "status": "cancelled",
+        "message": "Generation cancelled"
     }
+
+@app.get("/api/generations/{generation_id}/events")
+async def stream_generation_events(generation_id: str, request: Request):
+    """Server-Sent Events stream of status changes and denoising progress"""
+    # Subscribe before reading the current state so no event falls in between
+    queue = event_hub.subscribe(generation_id)
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                text(f"SELECT {GENERATION_COLUMNS} FROM generations WHERE id = :id"),
+                {"id": generation_id}
+            )
+            generation = result.fetchone()
+    except Exception:
+        event_hub.unsubscribe(generation_id, queue)
+        raise
     
-    # Add result URL if generation is completed
-    if generation.status == "completed" and generation.output_image_path:
-        response["resultUrl"] = f"http://localhost:8000/{generation.output_image_path}"
+    if not generation:
+        event_hub.unsubscribe(generation_id, queue)
+        raise HTTPException(status_code=404, detail="Generation not found")
     
-    # Add error message if generation failed
-    if generation.status == "error":
-        response["error"] = generation.error_message
+    async def event_stream():
+        try:
+            current = serialize_generation(generation)
+            yield format_sse("status", current)
+            if current["status"] in TERMINAL_STATUSES:
+                return
+            
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                
+                if event["type"] == "status":
+                    current = {**current, "status": event["status"]}
+                    if event.get("output_image_path"):
+                        current["resultUrl"] = result_url(event["output_image_path"])
+                    if event.get("preview_image_path"):
+                        current["previewUrl"] = result_url(event["preview_image_path"])
+                    if event.get("thumbnail_image_path"):
+                        current["thumbnailUrl"] = result_url(event["thumbnail_image_path"])
+                    if event.get("error"):
+                        current["error"] = event["error"]
+                    yield format_sse("status", current)
+                    if event["status"] in TERMINAL_STATUSES:
+                        return
+                else:
+                    yield format_sse(event["type"], {
+                        "id": generation_id,
+                        "step": event["step"],
+                        "total_steps": event["total_steps"]
+                    })
+        finally:
+            event_hub.unsubscribe(generation_id, queue)
     
-    return response
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.get("/api/generations")
 async def get_generation_history(
+    response: Response,
     limit: int = 10,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    preprocessor: Optional[str] = None,
     db: AsyncSession = Depends(get_db)
 ):
-    # Get recent generations from database
+    """Newest generations first, paginated by (created_at, id).
+    
+    Pass the X-Next-Cursor response header back as ``cursor`` to fetch the next page.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    conditions = []
+    params = {"limit": limit + 1}
+    
+    if status:
+        conditions.append("status = :status")
+        params["status"] = status
+    if preprocessor:
+        conditions.append("preprocessor = :preprocessor")
+        params["preprocessor"] = preprocessor
+    if cursor:
+        params["cursor_created_at"], params["cursor_id"] = decode_cursor(cursor)
+        conditions.append("(created_at, id) < (:cursor_created_at, :cursor_id)")
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
     result = await db.execute(
-        "SELECT * FROM generations ORDER BY created_at DESC LIMIT :limit",
-        {"limit": limit}
+        text(f"""
+        SELECT {GENERATION_COLUMNS} FROM generations
+        {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT :limit
+        """),
+        params
     )
     generations = result.fetchall()
     
-    response = []
-    for gen in generations:
-        gen_data = {
-            "id": gen.id,
-            "status": gen.status,
-            "prompt": gen.prompt,
-            "preprocessor": gen.preprocessor,
-            "created_at": gen.created_at.isoformat()
+    # One extra row tells us whether there is a next page
+    if len(generations) > limit:
+        generations = generations[:limit]
+        last = generations[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.created_at, last.id)
+    
+    return [serialize_generation(gen) for gen in generations]
+
+class GenerationBatchRequest(BaseModel):
+    ids: List[str] = Field(..., max_length=MAX_PAGE_SIZE)
+
+@app.post("/api/generations/batch")
+async def get_generation_batch(
+    request: GenerationBatchRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """Status of many generations in one query; unknown ids are omitted"""
+    if not request.ids:
+        return []
+    
+    result = await db.execute(
+        text(f"SELECT {GENERATION_COLUMNS} FROM generations WHERE id IN :ids")
+        .bindparams(bindparam("ids", expanding=True)),
+        {"ids": request.ids}
+    )
+    return [serialize_generation(gen) for gen in result.fetchall()]
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API disabled, set ADMIN_TOKEN to enable it")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+def serialize_dead_letter(message: aio_pika.IncomingMessage) -> dict:
+    headers = message.headers or {}
+    try:
+        task = json.loads(message.body)
+    except ValueError:
+        task = message.body.decode(errors="replace")
+    failed_at = headers.get("x-failed-at")
+    return {
+        "id": task.get("id") if isinstance(task, dict) else None,
+        "preprocessor": task.get("preprocessor") if isinstance(task, dict) else None,
+        "attempts": headers.get(ATTEMPT_HEADER, 1),
+        "error": headers.get("x-error"),
+        "failed_at": datetime.fromtimestamp(failed_at).isoformat() if failed_at else None,
+        "task": task
+    }
+
+@app.get("/api/admin/dead-letters", dependencies=[Depends(require_admin)])
+async def list_dead_letters(limit: int = 50):
+    """Tasks parked in the dead-letter queue, oldest first; they stay in the queue"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    async with dead_letters(limit) as (total, messages):
+        return {
+            "total": total,
+            "tasks": [serialize_dead_letter(message) for message in messages]
         }
-        
-        if gen.status == "completed" and gen.output_image_path:
-            gen_data["resultUrl"] = f"http://localhost:8000/{gen.output_image_path}"
-        
-        if gen.status == "error":
-            gen_data["error"] = gen.error_message
+
+class DeadLetterReplayRequest(BaseModel):
+    # Generation ids to replay, all held tasks (up to the page size) when omitted
+    ids: Optional[List[str]] = Field(None, max_length=MAX_PAGE_SIZE)
+
+@app.post("/api/admin/dead-letters/replay", dependencies=[Depends(require_admin)])
+async def replay_dead_letters(
+    request: DeadLetterReplayRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """Queue dead-lettered tasks again with a fresh set of attempts"""
+    wanted = set(request.ids) if request.ids is not None else None
+    replayed, skipped = [], []
+    
+    # The ids may be anywhere in the queue, so hold as much of it as allowed
+    async with dead_letters(MAX_PAGE_SIZE if wanted is None else 10 * MAX_PAGE_SIZE) as (_, messages):
+        for message in messages:
+            task = serialize_dead_letter(message)
+            generation_id = task["id"]
+            if wanted is not None and generation_id not in wanted:
+                continue
+            if not generation_id or not task["preprocessor"]:
+                skipped.append({"id": generation_id, "reason": "unreadable task"})
+                continue
+            
+            try:
+                result = await db.execute(
+                    text("""
+                    UPDATE generations 
+                    SET status = 'queued', error_message = NULL, dead_lettered_at = NULL 
+                    WHERE id = :id AND status = 'error'
+                    RETURNING id
+                    """),
+                    {"id": generation_id}
+                )
+            except IntegrityError:
+                # An identical request queued since holds the in-flight
+                # fingerprint; the task stays dead-lettered
+                await db.rollback()
+                skipped.append({"id": generation_id, "reason": "an identical generation is in flight"})
+                continue
+            requeued = result.fetchone()
+            if requeued:
+                # Queued through the outbox with the status change, so a failed
+                # publish cannot leave the generation queued without a task
+                replay = copy_task_message(message, **{ATTEMPT_HEADER: 1, "x-error": None, "x-failed-at": None})
+                db.add(OutboxMessage(
+                    generation_id=generation_id,
+                    routing_key=task["preprocessor"],
+                    priority=message.priority or 0,
+                    body=message.body.decode(),
+                    headers=json.dumps(replay.headers),
+                    created_at=datetime.now()
+                ))
+            await db.commit()
+            if not requeued:
+                # Cancelled, deleted or already replayed: drop it from the queue
+                await message.ack()
+                skipped.append({"id": generation_id, "reason": "generation is not in error"})
+                continue
             
-        response.append(gen_data)
+            await message.ack()
+            await publish_event_quietly(generation_id, {"type": "status", "id": generation_id, "status": "queued"})
+            replayed.append(generation_id)
     
-    return response
\ No newline at end of file
+    if wanted is not None:
+        found = set(replayed) | {item["id"] for item in skipped}
+        skipped += [{"id": generation_id, "reason": "not dead-lettered"} for generation_id in sorted(wanted - found)]
+    if replayed:
+        outbox_relay.notify()
+    return {"replayed": replayed, "skipped": skipped}
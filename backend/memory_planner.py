@@ -0,0 +1,149 @@
+import math
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+# Execution modes from fastest to most memory-frugal, each including the savings
+# of the ones before it: "sliced" computes attention one head at a time, "tiled"
+# also decodes the VAE tile by tile and one image at a time, "offload" also
+# keeps only the model currently running on the accelerator
+EXECUTION_MODES = ("normal", "sliced", "tiled", "offload")
+
+# "auto" lets the planner choose, any other mode is used for every call
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "auto")
+# Memory the pipeline may use on its device, 0 = a fraction of the device memory
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_BUDGET_FRACTION = float(os.getenv("MEMORY_BUDGET_FRACTION", "0.9"))
+
+# Largest input accepted, in pixels; larger uploads are downscaled to fit or
+# rejected, depending on OVERSIZE_INPUT_POLICY ("downscale" or "reject")
+MAX_INPUT_PIXELS = int(os.getenv("MAX_INPUT_PIXELS", str(1536 * 1536)))
+OVERSIZE_INPUT_POLICY = os.getenv("OVERSIZE_INPUT_POLICY", "downscale")
+
+# Shape of the Stable Diffusion 1.x models, used by the footprint estimate
+LATENT_FACTOR = 8
+ATTENTION_HEADS = 8
+UNET_CHANNELS = 320
+VAE_CHANNELS = 128
+# Feature maps alive at the peak, in units of the first UNet block's output
+# (skip connections and ControlNet residuals) and of a full resolution VAE
+# decoder map; calibrated against SD 1.5 at 512x512
+UNET_ACTIVATION_MAPS = 24
+VAE_ACTIVATION_MAPS = 4
+# Tile size the VAE decodes in when tiling is enabled (diffusers default)
+VAE_TILE_SIZE = 512
+
+
+class InputTooLarge(ValueError):
+    """Raised for inputs above MAX_INPUT_PIXELS when the policy is to reject them"""
+
+
+@dataclass(frozen=True)
+class ExecutionPlan:
+    mode: str
+    # Images per pipeline call, smaller than the batch when it had to be split
+    chunk_size: int
+    estimated_bytes: int
+    budget_bytes: int
+
+    @property
+    def fits(self) -> bool:
+        return not self.budget_bytes or self.estimated_bytes <= self.budget_bytes
+
+
+def admit_input(width: int, height: int) -> Tuple[int, int]:
+    """Size to process an input at: unchanged within the pixel budget, else
+    downscaled to fit it. Raises InputTooLarge when the policy is to reject."""
+    if not MAX_INPUT_PIXELS or width * height <= MAX_INPUT_PIXELS:
+        return width, height
+    if OVERSIZE_INPUT_POLICY == "reject":
+        raise InputTooLarge(
+            f"Input image is {width}x{height} ({width * height} pixels), "
+            f"the limit is {MAX_INPUT_PIXELS} pixels"
+        )
+    scale = math.sqrt(MAX_INPUT_PIXELS / (width * height))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def activation_bytes(
+    width: int,
+    height: int,
+    batch_size: int,
+    mode: str,
+    dtype_bytes: int,
+    guidance: bool = True,
+    fused_attention: bool = False
+) -> int:
+    """Upper estimate of the peak activation memory of one pipeline call"""
+    tokens = (width // LATENT_FACTOR) * (height // LATENT_FACTOR)
+    # Classifier-free guidance runs the UNet on a conditional and an unconditional copy
+    streams = batch_size * (2 if guidance else 1)
+
+    if fused_attention:
+        # Fused kernels never materialize the attention scores
+        attention = 0
+    elif mode == "normal":
+        # Scores and softmax of the highest resolution transformer blocks
+        attention = 2 * streams * ATTENTION_HEADS * tokens ** 2 * dtype_bytes
+    else:
+        attention = 2 * tokens ** 2 * dtype_bytes
+    unet = UNET_ACTIVATION_MAPS * streams * tokens * UNET_CHANNELS * dtype_bytes
+
+    if mode in ("tiled", "offload"):
+        decoded_pixels = min(width, VAE_TILE_SIZE) * min(height, VAE_TILE_SIZE)
+    else:
+        decoded_pixels = batch_size * width * height
+    vae = VAE_ACTIVATION_MAPS * decoded_pixels * VAE_CHANNELS * dtype_bytes
+
+    # Denoising and decoding never run at the same time
+    return max(attention + unet, vae)
+
+
+def plan_execution(
+    width: int,
+    height: int,
+    batch_size: int,
+    dtype_bytes: int,
+    budget_bytes: int,
+    resident_bytes: int,
+    offload_bytes: int,
+    guidance: bool = True,
+    fused_attention: bool = False,
+    can_offload: bool = True,
+    mode: Optional[str] = None
+) -> ExecutionPlan:
+    """Choose how to run a batch of ``width`` x ``height`` images within ``budget_bytes``.
+
+    ``resident_bytes`` is the weight memory held on the device normally and
+    ``offload_bytes`` the part still held with model offload. Slicing and tiling
+    are tried on the whole batch first, then the batch is split, and offload is
+    the last resort. The most frugal plan is returned when nothing fits.
+    """
+    mode = mode or EXECUTION_MODE
+
+    def estimate(candidate: str, chunk_size: int) -> ExecutionPlan:
+        weights = offload_bytes if candidate == "offload" else resident_bytes
+        activations = activation_bytes(
+            width, height, chunk_size, candidate, dtype_bytes, guidance, fused_attention
+        )
+        return ExecutionPlan(candidate, chunk_size, weights + activations, budget_bytes)
+
+    if mode != "auto":
+        return estimate(mode, batch_size)
+
+    chunk_sizes = []
+    chunk_size = batch_size
+    while chunk_size >= 1:
+        chunk_sizes.append(chunk_size)
+        chunk_size //= 2
+    candidates = [(candidate, batch_size) for candidate in ("normal", "sliced", "tiled")]
+    candidates += [("tiled", size) for size in chunk_sizes[1:]]
+    if can_offload:
+        candidates += [("offload", size) for size in chunk_sizes]
+
+    plan = None
+    for candidate, size in candidates:
+        plan = estimate(candidate, size)
+        if plan.fits:
+            return plan
+    return plan
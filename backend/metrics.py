@@ -0,0 +1,157 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Worker metrics
+BATCH_SIZE = Histogram(
+    "sd_worker_batch_size",
+    "Number of tasks sent through a single pipeline call",
+    ["preprocessor"],
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32)
+)
+STAGE_QUEUE_DEPTH = Gauge(
+    "sd_worker_stage_queue_depth",
+    "Jobs waiting in a worker stage queue",
+    ["stage"]
+)
+STAGE_QUEUE_WAIT = Histogram(
+    "sd_worker_stage_queue_wait_seconds",
+    "Time a job waited in a worker stage queue",
+    ["stage"]
+)
+STAGE_LATENCY = Histogram(
+    "sd_worker_stage_latency_seconds",
+    "Time spent processing a job in a worker stage",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+)
+EXECUTOR_IN_FLIGHT = Gauge(
+    "sd_worker_executor_in_flight",
+    "Blocking calls currently running in a worker executor",
+    ["executor"]
+)
+EXECUTOR_WAIT = Histogram(
+    "sd_worker_executor_wait_seconds",
+    "Time spent waiting for a free executor slot",
+    ["executor"]
+)
+LOOP_LAG = Histogram(
+    "sd_worker_event_loop_lag_seconds",
+    "Delay between a scheduled event loop wakeup and when it ran",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+COMPONENT_LOAD_SECONDS = Histogram(
+    "sd_worker_component_load_seconds",
+    "Time taken to load a model component at startup or first use",
+    ["component"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320, 640)
+)
+
+QUEUE_WAIT = Histogram(
+    "sd_worker_queue_wait_seconds",
+    "Time from a task being queued by the API to it being claimed by a worker",
+    ["priority"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 1800, 3600)
+)
+CONTROL_MAP_SECONDS = Histogram(
+    "sd_worker_control_map_seconds",
+    "Time taken to produce a control image, from the cache or the preprocessor",
+    ["preprocessor", "cache"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+DENOISE_SECONDS = Histogram(
+    "sd_worker_denoise_seconds",
+    "Duration of one pipeline call, for the whole batch",
+    ["preprocessor"],
+    buckets=(0.5, 1, 2, 4, 8, 15, 30, 60, 120, 240)
+)
+IMAGE_SAVE_SECONDS = Histogram(
+    "sd_worker_image_save_seconds",
+    "Time taken to encode and write an output with its preview and thumbnail",
+    ["format"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+TASK_QUEUE_DEPTH = Gauge(
+    "sd_worker_task_queue_depth",
+    "Messages ready in a task queue, as last reported by the broker",
+    ["queue"]
+)
+TASKS_IN_FLIGHT = Gauge(
+    "sd_worker_tasks_in_flight",
+    "Task messages held by the worker, admitted or waiting for the scheduler",
+    ["state"]
+)
+ACCELERATOR_MEMORY_BYTES = Gauge(
+    "sd_worker_accelerator_memory_bytes",
+    "Memory held by tensors on the accelerator",
+    ["kind"]
+)
+DISK_FREE_BYTES = Gauge(
+    "sd_worker_disk_free_bytes",
+    "Free space on the volume holding uploads and outputs"
+)
+EXECUTION_PLANS = Counter(
+    "sd_worker_execution_plans",
+    "Pipeline calls by the execution mode the memory planner chose",
+    ["mode"]
+)
+TASK_RETRIES = Counter(
+    "sd_worker_task_retries",
+    "Failed task attempts scheduled for another attempt",
+    ["preprocessor"]
+)
+TASKS_DEAD_LETTERED = Counter(
+    "sd_worker_tasks_dead_lettered",
+    "Tasks moved to the dead-letter queue, after their last attempt or a permanent error",
+    ["reason"]
+)
+OVERSIZE_INPUTS = Counter(
+    "sd_worker_oversize_inputs",
+    "Inputs above the pixel budget, by whether they were downscaled or rejected",
+    ["action"]
+)
+
+# Metrics shared by the API and the worker
+DB_WRITE_SECONDS = Histogram(
+    "sd_db_write_seconds",
+    "Duration of a database write, including the commit",
+    ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+# API metrics
+REQUEST_SECONDS = Histogram(
+    "sd_api_request_seconds",
+    "API request latency",
+    ["method", "route", "status"]
+)
+PUBLISH_SECONDS = Histogram(
+    "sd_api_publish_seconds",
+    "Time taken to publish a batch of outbox tasks and receive the broker's confirms",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+)
+GENERATIONS_BY_STATUS = Gauge(
+    "sd_api_generations",
+    "Generations waiting or running, counted when metrics are scraped",
+    ["status"]
+)
+OLDEST_QUEUED_AGE = Gauge(
+    "sd_api_oldest_queued_age_seconds",
+    "Age of the oldest generation still waiting for a worker"
+)
+OUTBOX_BACKLOG = Gauge(
+    "sd_api_outbox_backlog",
+    "Task messages committed but not yet confirmed by the broker"
+)
+STORED_BYTES = Gauge(
+    "sd_api_stored_bytes",
+    "Size of the indexed uploads and outputs, as of the last retention sweep"
+)
+GENERATIONS_EXPIRED = Counter(
+    "sd_api_generations_expired",
+    "Generations whose files were released by the retention service",
+    ["policy"]
+)
+FILES_DELETED = Counter(
+    "sd_api_files_deleted",
+    "Uploads and outputs deleted once no generation referenced them",
+    ["kind"]
+)
\ No newline at end of file
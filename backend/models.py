@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Text
+from sqlalchemy import Column, String, DateTime, Text, Integer, BigInteger, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -11,6 +11,78 @@ class Generation(Base):
     preprocessor = Column(String, nullable=False)
     input_image_path = Column(String, nullable=False)
     output_image_path = Column(String, nullable=True)
-    status = Column(String, nullable=False)  # 'processing', 'completed', 'error'
+    # Downscaled copies written with the output for galleries and result views
+    preview_image_path = Column(String, nullable=True)
+    thumbnail_image_path = Column(String, nullable=True)
+    status = Column(String, nullable=False)  # 'queued', 'processing', 'completed', 'error', 'cancelled', 'expired'
     error_message = Column(Text, nullable=True)
-    created_at = Column(DateTime, nullable=False)
\ No newline at end of file
+    # Set while the failed task waits in the dead-letter queue for a replay
+    dead_lettered_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    # Inputs that determine the output, hashed into the request fingerprint
+    input_sha256 = Column(String, nullable=True)
+    seed = Column(Integer, nullable=True)
+    preset = Column(String, nullable=True)
+    num_inference_steps = Column(Integer, nullable=True)
+    output_format = Column(String, nullable=True)  # Key of encoding.OUTPUT_FORMATS, None = png
+    output_quality = Column(Integer, nullable=True)
+    fingerprint = Column(String, nullable=True)
+    # Scheduling: priority class and the tenant whose fair share the job counts against
+    priority = Column(String, nullable=True)
+    tenant = Column(String, nullable=True)
+    # W3C trace id shared by the API request and the worker spans of this job
+    trace_id = Column(String, nullable=True)
+    # Client-chosen key making retried submissions return the original generation
+    idempotency_key = Column(String, nullable=True)
+    
+    __table_args__ = (
+        # Keyset pagination of the history, optionally filtered by status or preprocessor
+        Index("ix_generations_created_at_id", "created_at", "id"),
+        Index("ix_generations_status_created_at_id", "status", "created_at", "id"),
+        Index("ix_generations_preprocessor_created_at_id", "preprocessor", "created_at", "id"),
+        # Completed results are reused for identical requests
+        Index(
+            "ix_generations_fingerprint_completed", "fingerprint",
+            postgresql_where=text("status = 'completed'"),
+            sqlite_where=text("status = 'completed'")
+        ),
+        # At most one in-flight job per fingerprint, identical requests join it
+        Index(
+            "uq_generations_fingerprint_in_flight", "fingerprint", unique=True,
+            postgresql_where=text("status IN ('queued', 'processing')"),
+            sqlite_where=text("status IN ('queued', 'processing')")
+        ),
+        Index("uq_generations_idempotency_key", "idempotency_key", unique=True),
+        # Garbage collection looks up the generations still using an upload
+        Index("ix_generations_input_image_path", "input_image_path"),
+    )
+
+class OutboxMessage(Base):
+    """A task message committed with its generation, published by the outbox relay"""
+    __tablename__ = "task_outbox"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    generation_id = Column(String, nullable=False)
+    routing_key = Column(String, nullable=False)  # Preprocessor queue the task goes to
+    priority = Column(Integer, nullable=False)
+    body = Column(Text, nullable=False)
+    headers = Column(Text, nullable=True)  # JSON object
+    created_at = Column(DateTime, nullable=False)
+
+class StoredFile(Base):
+    """An upload or output file on disk, indexed so retention never has to scan the directories"""
+    __tablename__ = "stored_files"
+    
+    path = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)  # 'upload' or 'output'
+    # Generation an output was written for; uploads are shared by content hash
+    generation_id = Column(String, nullable=True)
+    size_bytes = Column(BigInteger, nullable=False)
+    # When the file was written or, for uploads, last submitted again
+    recorded_at = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        # Orphan sweeps page through the index in (recorded_at, path) order
+        Index("ix_stored_files_recorded_at_path", "recorded_at", "path"),
+        Index("ix_stored_files_generation_id", "generation_id"),
+    )
\ No newline at end of file
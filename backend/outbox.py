@@ -0,0 +1,131 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+from typing import Optional
+
+import aio_pika
+from sqlalchemy.sql import text, bindparam
+
+from database import async_session, engine
+from metrics import PUBLISH_SECONDS
+from models import OutboxMessage
+from rabbitmq import publish_tasks
+
+# Messages published per batch, and how often the outbox is checked for
+# messages nobody signalled (committed by a process that died before publishing)
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+
+DELETE_PUBLISHED = text("DELETE FROM task_outbox WHERE id IN :ids").bindparams(bindparam("ids", expanding=True))
+
+
+def outbox_message(generation_id: str, preprocessor: str, priority: int, task: dict,
+                   headers: Optional[dict] = None) -> OutboxMessage:
+    """The outbox row for a task, to be added in the transaction that creates its generation"""
+    return OutboxMessage(
+        generation_id=generation_id,
+        routing_key=preprocessor,
+        priority=priority,
+        body=json.dumps(task),
+        headers=json.dumps(headers) if headers else None,
+        created_at=datetime.now()
+    )
+
+
+class OutboxRelay:
+    """Publishes task messages from the outbox table to RabbitMQ.
+
+    Generations are committed together with their task messages, and the
+    relay publishes those in batches with publisher confirms, deleting each
+    only once the broker confirmed it. A crash before the publish delays a
+    task instead of losing it; a crash between the confirm and the delete
+    publishes it twice, and the worker's atomic claim runs it once. On
+    PostgreSQL, rows are locked with SKIP LOCKED so that with several API
+    processes each message is sent by one relay at a time.
+    """
+
+    def __init__(self, batch_size: int = OUTBOX_BATCH_SIZE, poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        """Publish pending messages now rather than at the next poll"""
+        self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def relay(self) -> int:
+        """Publish one batch of pending messages, returning how many were confirmed"""
+        lock = " FOR UPDATE SKIP LOCKED" if engine.dialect.name == "postgresql" else ""
+        async with async_session() as session:
+            result = await session.execute(
+                text(f"""
+                SELECT id, generation_id, routing_key, priority, body, headers FROM task_outbox
+                ORDER BY id
+                LIMIT :limit{lock}
+                """),
+                {"limit": self.batch_size}
+            )
+            rows = result.fetchall()
+            if not rows:
+                return 0
+
+            started_at = time.perf_counter()
+            errors = await publish_tasks([
+                (
+                    row.routing_key,
+                    aio_pika.Message(
+                        body=row.body.encode(),
+                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                        priority=row.priority,
+                        headers=json.loads(row.headers) if row.headers else None,
+                        message_id=row.generation_id
+                    )
+                )
+                for row in rows
+            ])
+            PUBLISH_SECONDS.observe(time.perf_counter() - started_at)
+
+            confirmed = []
+            for row, error in zip(rows, errors):
+                if error is None:
+                    confirmed.append(row.id)
+                else:
+                    print(f"Error publishing task for generation {row.generation_id}: {str(error)}")
+            if confirmed:
+                await session.execute(DELETE_PUBLISHED, {"ids": confirmed})
+            await session.commit()
+            return len(confirmed)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                sent = await self.relay()
+            except Exception as e:
+                print(f"Error relaying task outbox: {str(e)}")
+                sent = 0
+            if sent == self.batch_size:
+                # A full batch, more may be waiting
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox_relay = OutboxRelay()
@@ -0,0 +1,270 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+from diffusers import (
+    StableDiffusionPipeline,
+    StableDiffusionControlNetPipeline,
+    ControlNetModel,
+    UniPCMultistepScheduler,
+    DPMSolverMultistepScheduler,
+)
+
+from metrics import COMPONENT_LOAD_SECONDS
+
+# Schedulers selectable per call, "default" is the one shipped with the base model
+SCHEDULERS = {
+    "default": None,
+    "unipc": UniPCMultistepScheduler,
+    "dpmpp": DPMSolverMultistepScheduler,
+}
+
+
+def module_size_bytes(module: torch.nn.Module) -> int:
+    """Approximate the memory held by a module's parameters and buffers"""
+    total = sum(p.numel() * p.element_size() for p in module.parameters())
+    total += sum(b.numel() * b.element_size() for b in module.buffers())
+    return total
+
+
+class PipelineCache:
+    """Long-lived registry of ControlNet pipelines keyed by preprocessor.
+
+    The base Stable Diffusion components (UNet, VAE, text encoder) are loaded
+    once and shared by every pipeline. ControlNets are registered by key as
+    loaders, so they are only loaded when first needed, and are kept
+    on the device in LRU order; when the resident footprint would exceed
+    ``budget_bytes`` the least recently used ControlNet is moved back to host
+    memory. ControlNets pinned by a running call (see ``pinned``) are never
+    evicted. A budget of 0 disables eviction.
+
+    Every lookup returns a thin pipeline wrapping the resident modules with a
+    fresh scheduler instance, so switching schedulers never reloads weights and
+    concurrent calls do not share scheduler state.
+
+    Execution modes (attention slicing, VAE tiling, model offload) change the
+    shared modules, so calls are run through ``execution_mode``, which only
+    lets calls of the same mode overlap.
+    """
+
+    def __init__(
+        self,
+        base_model_id: str,
+        device: str,
+        torch_dtype: torch.dtype,
+        budget_bytes: int = 0,
+        pretrained_kwargs: Optional[dict] = None
+    ):
+        self.base_model_id = base_model_id
+        self.device = device
+        self.torch_dtype = torch_dtype
+        self.budget_bytes = budget_bytes
+        self.pretrained_kwargs = pretrained_kwargs or {}
+
+        self._controlnets: Dict[str, Callable[[], ControlNetModel]] = {}
+        self._pipelines: "OrderedDict[str, StableDiffusionControlNetPipeline]" = OrderedDict()
+        self._base_components: Optional[dict] = None
+        self._scheduler_config = None
+        self._base_bytes = 0
+        self._lock = threading.RLock()
+        # Calls running with each key's ControlNet
+        self._pins: Dict[str, int] = {}
+
+        # Execution mode of the calls in flight and the (mode, key) the modules
+        # are configured for; offload hooks belong to the pipeline that added them
+        self._mode_changed = threading.Condition()
+        self._mode = "normal"
+        self._mode_key: Optional[str] = None
+        self._mode_users = 0
+        self._configured: Optional[Tuple[str, str]] = None
+        self._offloaded: Optional[StableDiffusionControlNetPipeline] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def register(self, key: str, controlnet_loader: Callable[[], ControlNetModel]):
+        """Attach a ControlNet under a preprocessor key, loaded by calling ``controlnet_loader``"""
+        with self._lock:
+            self._controlnets[key] = controlnet_loader
+            self._pipelines.pop(key, None)
+
+    def get(self, key: str, scheduler: str = "default") -> StableDiffusionControlNetPipeline:
+        """Return the pipeline for ``key`` using the named scheduler"""
+        if scheduler not in SCHEDULERS:
+            raise ValueError(f"Unsupported scheduler: {scheduler}")
+        pipe = self._get_resident(key)
+        scheduler_cls = SCHEDULERS[scheduler] or type(pipe.scheduler)
+        components = dict(pipe.components)
+        components["scheduler"] = scheduler_cls.from_config(self._scheduler_config)
+        return StableDiffusionControlNetPipeline(**components)
+
+    @contextmanager
+    def pinned(self, key: str, scheduler: str = "default"):
+        """``get(key, scheduler)``, keeping the ControlNet on the device until the block exits"""
+        with self._lock:
+            pipe = self.get(key, scheduler)
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield pipe
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+
+    def _get_resident(self, key: str) -> StableDiffusionControlNetPipeline:
+        """The resident pipeline for ``key``, built from the shared base on a miss"""
+        with self._lock:
+            pipe = self._pipelines.get(key)
+            if pipe is not None:
+                self._pipelines.move_to_end(key)
+                self.hits += 1
+                return pipe
+
+            self.misses += 1
+            controlnet_loader = self._controlnets.get(key)
+            if controlnet_loader is None:
+                raise ValueError(f"Unsupported preprocessor: {key}")
+
+            controlnet = controlnet_loader()
+            self._make_room(module_size_bytes(controlnet))
+            self.load_base()
+            controlnet.to(self.device)
+            pipe = StableDiffusionControlNetPipeline(**self._base_components, controlnet=controlnet)
+
+            self._pipelines[key] = pipe
+            return pipe
+
+    @contextmanager
+    def execution_mode(self, key: str, pipe: StableDiffusionControlNetPipeline, mode: str):
+        """Configure ``pipe`` (from ``get(key)``) for ``mode`` around a call.
+
+        Waits for calls in another mode to finish first. Offloaded calls are
+        also exclusive per key, as the offload hooks chain one ControlNet.
+        """
+        def compatible() -> bool:
+            if not self._mode_users:
+                return True
+            return mode == self._mode and (mode != "offload" or key == self._mode_key)
+
+        with self._mode_changed:
+            self._mode_changed.wait_for(compatible)
+            self._mode, self._mode_key = mode, key
+            self._mode_users += 1
+            try:
+                if self._configured != (mode, key):
+                    self._configure(pipe, mode)
+                    self._configured = (mode, key)
+            except BaseException:
+                self._mode_users -= 1
+                self._mode_changed.notify_all()
+                raise
+        try:
+            yield pipe
+        finally:
+            with self._mode_changed:
+                self._mode_users -= 1
+                self._mode_changed.notify_all()
+
+    def _configure(self, pipe: StableDiffusionControlNetPipeline, mode: str):
+        if self._offloaded is not None:
+            # Back to keeping every module on the device
+            self._offloaded.remove_all_hooks()
+            self._offloaded.to(self.device)
+            self._offloaded = None
+
+        if mode == "normal":
+            pipe.disable_attention_slicing()
+        else:
+            pipe.enable_attention_slicing("max")
+        if mode in ("tiled", "offload"):
+            pipe.vae.enable_tiling()
+            pipe.vae.enable_slicing()
+        else:
+            pipe.vae.disable_tiling()
+            pipe.vae.disable_slicing()
+        if mode == "offload":
+            with self._lock:
+                pipe.enable_model_cpu_offload(device=self.device)
+            self._offloaded = pipe
+        print(f"Pipeline execution mode set to '{mode}'")
+
+    def offload_bytes(self, pipe: StableDiffusionControlNetPipeline) -> int:
+        """Weights on the device while ``pipe`` (from ``get``) denoises with model
+        offload: the UNet and the ControlNet. Not counted as a lookup"""
+        return module_size_bytes(pipe.unet) + module_size_bytes(pipe.controlnet)
+
+    def preload(self, keys):
+        """Load the base and the pipelines for ``keys`` ahead of the first call"""
+        for key in keys:
+            self._get_resident(key)
+
+    def modules(self) -> list:
+        """The torch modules of the base and the resident ControlNets"""
+        with self._lock:
+            modules = [
+                component for component in (self._base_components or {}).values()
+                if isinstance(component, torch.nn.Module)
+            ]
+            return modules + [pipe.controlnet for pipe in self._pipelines.values()]
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return self._base_bytes + sum(
+                module_size_bytes(pipe.controlnet) for pipe in self._pipelines.values()
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident": list(self._pipelines.keys()),
+                "resident_bytes": self.resident_bytes(),
+            }
+
+    def load_base(self):
+        """Load the shared base components onto the device if not loaded yet"""
+        with self._lock:
+            if self._base_components is not None:
+                return
+            print(f"Loading base pipeline {self.base_model_id}...")
+            started_at = time.perf_counter()
+            pipe = StableDiffusionPipeline.from_pretrained(
+                self.base_model_id,
+                torch_dtype=self.torch_dtype,
+                **self.pretrained_kwargs
+            ).to(self.device)
+
+            self._base_components = dict(pipe.components)
+            self._scheduler_config = pipe.scheduler.config
+            self._base_bytes = sum(
+                module_size_bytes(component)
+                for component in self._base_components.values()
+                if isinstance(component, torch.nn.Module)
+            )
+            elapsed = time.perf_counter() - started_at
+            COMPONENT_LOAD_SECONDS.labels(component="base_pipeline").observe(elapsed)
+            print(f"Base pipeline loaded in {elapsed:.1f}s ({self._base_bytes / 1024**3:.2f} GB)")
+
+    def _make_room(self, needed: int):
+        if not self.budget_bytes:
+            return
+        freed = False
+        while self._pipelines and self.resident_bytes() + needed > self.budget_bytes:
+            key = next((key for key in self._pipelines if not self._pins.get(key)), None)
+            if key is None:
+                print(f"Warning: every resident ControlNet is in use, loading over the {self.budget_bytes / 1024**3:.2f} GB budget")
+                break
+            pipe = self._pipelines.pop(key)
+            pipe.controlnet.to("cpu")
+            self.evictions += 1
+            freed = True
+            print(f"Evicted ControlNet '{key}' from {self.device}")
+        if freed and torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -1,14 +1,144 @@
 import aio_pika
+import aio_pika.pool
 import asyncio
-from typing import Optional
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from generation_config import CONTROLNET_MODELS, PRIORITY_CLASSES
+
+# Direct exchange routing each task to the queue of its preprocessor, so workers
+# can consume only the preprocessors whose ControlNet they keep warm
+TASKS_EXCHANGE = "sd_controlnet_tasks"
+# Queue all tasks went to before per-preprocessor routing, still drained by workers
+LEGACY_TASK_QUEUE = "sd_controlnet_tasks"
+
+# Failed tasks are retried after an exponential backoff (base, 2x base, ...)
+# until MAX_TASK_ATTEMPTS, then parked in the dead-letter queue
+MAX_TASK_ATTEMPTS = int(os.getenv("MAX_TASK_ATTEMPTS", "3"))
+RETRY_BASE_DELAY_MS = int(os.getenv("RETRY_BASE_DELAY_MS", "5000"))
+DEAD_LETTER_QUEUE = "sd_controlnet_tasks.dead"
+# Header carrying the 1-based attempt number of a task message
+ATTEMPT_HEADER = "x-attempt"
+
+# Confirm-mode channels task messages are published on
+PUBLISH_CHANNELS = int(os.getenv("PUBLISH_CHANNELS", "2"))
+
+# Topic exchange carrying generation status and progress events,
+# routed as "<event type>.<generation id>"
+EVENTS_EXCHANGE = "generation_events"
 
 # Global connection and channel variables
 connection: Optional[aio_pika.Connection] = None
 channel: Optional[aio_pika.Channel] = None
+events_exchange: Optional[aio_pika.Exchange] = None
+tasks_exchange: Optional[aio_pika.Exchange] = None
+publish_channels: Optional[aio_pika.pool.Pool] = None
+
+def task_queue_name(preprocessor: str) -> str:
+    return f"{TASKS_EXCHANGE}.{preprocessor}"
+
+async def declare_task_queues(
+    channel: aio_pika.Channel,
+    preprocessors: Iterable[str] = CONTROLNET_MODELS
+) -> Tuple[aio_pika.Exchange, Dict[str, aio_pika.Queue]]:
+    """Declare the tasks exchange and the durable queue of each preprocessor"""
+    exchange = await channel.declare_exchange(
+        TASKS_EXCHANGE,
+        aio_pika.ExchangeType.DIRECT,
+        durable=True
+    )
+    queues = {}
+    for preprocessor in preprocessors:
+        queue = await channel.declare_queue(
+            task_queue_name(preprocessor),
+            durable=True,
+            arguments={"x-max-priority": max(PRIORITY_CLASSES.values())}
+        )
+        await queue.bind(exchange, routing_key=preprocessor)
+        queues[preprocessor] = queue
+    return exchange, queues
+
+async def consume_task_queues(
+    channel: aio_pika.Channel,
+    preprocessors: Iterable[str],
+    on_message: Callable[[aio_pika.IncomingMessage], Awaitable[None]]
+) -> Tuple[Dict[str, aio_pika.Queue], List[aio_pika.Queue]]:
+    """Consume the task queues of ``preprocessors``, returning every task queue
+    by preprocessor and the queues left to other workers"""
+    _, queues = await declare_task_queues(channel)
+    served = [preprocessor for preprocessor in preprocessors if preprocessor in queues]
+    for preprocessor in served:
+        await queues[preprocessor].consume(on_message)
+        print(f"Consuming queue: {queues[preprocessor].name}")
+    return queues, [queue for preprocessor, queue in queues.items() if preprocessor not in served]
+
+async def steal_task(queues: Iterable[aio_pika.Queue]) -> Optional[aio_pika.IncomingMessage]:
+    """Take the next task from the first of ``queues`` holding one, None when all are empty"""
+    for queue in queues:
+        try:
+            message = await queue.get(fail=False)
+        except Exception as e:
+            print(f"Error stealing from {queue.name}: {str(e)}")
+            continue
+        if message is not None:
+            print(f"Stealing task from {queue.name}")
+            return message
+    return None
+
+def retry_delay_ms(attempt: int) -> int:
+    """Delay before retrying a task whose ``attempt``-th attempt failed"""
+    return RETRY_BASE_DELAY_MS * 2 ** (attempt - 1)
+
+def retry_queue_name(delay_ms: int) -> str:
+    # Named by delay, as the TTL of an existing queue cannot be changed
+    return f"{TASKS_EXCHANGE}.retry.{delay_ms}ms"
+
+async def declare_retry_queues(channel: aio_pika.Channel) -> Dict[int, aio_pika.Exchange]:
+    """Declare the delay stage of each retry, returning its exchange by failed attempt.
+
+    Each stage is a fanout exchange feeding a queue whose messages expire
+    after the stage's delay and are then dead-lettered to the tasks exchange,
+    keeping their preprocessor routing key. A fixed TTL per queue means
+    messages expire in the order they were queued.
+    """
+    exchanges = {}
+    for attempt in range(1, MAX_TASK_ATTEMPTS):
+        name = retry_queue_name(retry_delay_ms(attempt))
+        exchange = await channel.declare_exchange(name, aio_pika.ExchangeType.FANOUT, durable=True)
+        queue = await channel.declare_queue(
+            name,
+            durable=True,
+            arguments={
+                "x-message-ttl": retry_delay_ms(attempt),
+                "x-dead-letter-exchange": TASKS_EXCHANGE,
+            }
+        )
+        await queue.bind(exchange)
+        exchanges[attempt] = exchange
+    return exchanges
+
+async def declare_dead_letter_queue(channel: aio_pika.Channel) -> aio_pika.Queue:
+    return await channel.declare_queue(DEAD_LETTER_QUEUE, durable=True)
+
+def copy_task_message(message: aio_pika.abc.AbstractMessage, **headers) -> aio_pika.Message:
+    """A persistent copy of a task message with ``headers`` added to its own (None removes one)"""
+    merged = {**(message.headers or {}), **headers}
+    return aio_pika.Message(
+        body=message.body,
+        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        priority=message.priority,
+        headers={name: value for name, value in merged.items() if value is not None}
+    )
+
+async def open_publish_channel() -> aio_pika.Channel:
+    # In confirm mode publish() returns once the broker has taken the message
+    return await connection.channel(publisher_confirms=True)
 
 async def init_rabbitmq():
     """Initialize RabbitMQ connection and channel"""
-    global connection, channel
+    global connection, channel, events_exchange, tasks_exchange, publish_channels
     
     # Connect to RabbitMQ
     # connection = await aio_pika.connect_robust(
@@ -21,34 +151,102 @@ async def init_rabbitmq():
     # Create channel
     channel = await connection.channel()
     
-    # Declare queue
-    await channel.declare_queue(
-        "sd_controlnet_tasks",
-        durable=True
+    # Declare the per-preprocessor task queues
+    tasks_exchange, _ = await declare_task_queues(channel)
+    
+    events_exchange = await channel.declare_exchange(
+        EVENTS_EXCHANGE,
+        aio_pika.ExchangeType.TOPIC
     )
     
+    publish_channels = aio_pika.pool.Pool(open_publish_channel, max_size=PUBLISH_CHANNELS)
+    
     print("RabbitMQ connection established")
 
-async def publish_message(message: str):
-    """Publish a message to the queue"""
+async def publish_tasks(messages: List[Tuple[str, aio_pika.Message]]) -> List[Optional[BaseException]]:
+    """Publish (preprocessor, message) pairs to the tasks exchange on a pooled confirm-mode channel.
+
+    The publishes are pipelined, so a batch waits for the broker's confirms
+    about once. Returns None for each confirmed message, else its error.
+    """
     if not channel:
         await init_rabbitmq()
-        
-    await channel.default_exchange.publish(
+    
+    async with publish_channels.acquire() as publish_channel:
+        exchange = await publish_channel.get_exchange(TASKS_EXCHANGE, ensure=False)
+        results = await asyncio.gather(
+            *(exchange.publish(message, routing_key=preprocessor) for preprocessor, message in messages),
+            return_exceptions=True
+        )
+    return [result if isinstance(result, BaseException) else None for result in results]
+
+@asynccontextmanager
+async def dead_letters(limit: int):
+    """Hold up to ``limit`` dead-lettered task messages without removing them.
+
+    Yields the number of messages in the queue and the messages held. Those
+    the caller does not ack are returned to the queue on exit.
+    """
+    if not channel:
+        await init_rabbitmq()
+    
+    queue = await declare_dead_letter_queue(channel)
+    total = queue.declaration_result.message_count
+    messages: List[aio_pika.IncomingMessage] = []
+    try:
+        while len(messages) < limit:
+            message = await queue.get(fail=False)
+            if message is None:
+                break
+            messages.append(message)
+        yield total, messages
+    finally:
+        for message in messages:
+            if not message.processed:
+                await message.nack(requeue=True)
+
+async def publish_event(generation_id: str, event: dict):
+    """Publish a transient generation event"""
+    if not channel:
+        await init_rabbitmq()
+    
+    await events_exchange.publish(
         aio_pika.Message(
-            body=message.encode(),
-            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+            body=json.dumps(event).encode(),
+            content_type="application/json"
         ),
-        routing_key="sd_controlnet_tasks"
+        routing_key=f"{event['type']}.{generation_id}"
     )
 
+async def consume_events(handler: Callable[[dict], Awaitable[None]], *event_types: str):
+    """Deliver generation events of the given types to ``handler``"""
+    if not channel:
+        await init_rabbitmq()
+    
+    # Each API process gets its own exclusive queue so every process sees every event
+    queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+    for event_type in event_types:
+        await queue.bind(events_exchange, routing_key=f"{event_type}.*")
+    
+    async def on_message(message: aio_pika.IncomingMessage):
+        async with message.process():
+            await handler(json.loads(message.body))
+    
+    await queue.consume(on_message)
+
 async def close_rabbitmq():
     """Close RabbitMQ connection"""
-    global connection, channel
+    global connection, channel, events_exchange, tasks_exchange, publish_channels
+    
+    if publish_channels:
+        await publish_channels.close()
+        publish_channels = None
     
     if channel:
         await channel.close()
         channel = None
+        events_exchange = None
+        tasks_exchange = None
         
     if connection:
         await connection.close()
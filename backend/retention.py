@@ -0,0 +1,341 @@
+"""Lifecycle of uploads and outputs on disk.
+
+Every file the API or a worker writes is recorded in the ``stored_files``
+index, so retention works from the database instead of scanning directories.
+Generations past their retention age, or the oldest ones when the indexed
+files exceed ``STORAGE_QUOTA_MB`` or free disk space falls below
+``MIN_FREE_DISK_MB``, are marked ``expired`` and lose their output paths; failed generations whose
+task waits in the dead-letter queue are kept for a replay. A
+file is deleted once no unexpired generation references it; uploads are shared
+by content hash, so one may outlive the generation it was uploaded for.
+
+``python retention.py backfill`` indexes files written before the index
+existed, the only operation that lists the directories.
+"""
+import asyncio
+import os
+import shutil
+import sys
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy.sql import text, bindparam
+from starlette.concurrency import run_in_threadpool
+
+from database import async_session, init_db
+from metrics import FILES_DELETED, GENERATIONS_EXPIRED, STORED_BYTES
+from storage import UPLOAD_DIR
+
+OUTPUT_DIR = "generations"
+
+# Completed generations are kept RETENTION_DAYS (0 = forever); failed and
+# cancelled ones, which only hold their upload, FAILED_RETENTION_HOURS
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "0"))
+FAILED_RETENTION_HOURS = float(os.getenv("FAILED_RETENTION_HOURS", "24"))
+# Limit on the indexed files (0 = none), and the free space below which the
+# oldest generations are expired whatever their age
+STORAGE_QUOTA_MB = int(os.getenv("STORAGE_QUOTA_MB", "0"))
+MIN_FREE_DISK_MB = int(os.getenv("MIN_FREE_DISK_MB", "1024"))
+# Unreferenced files younger than this are left alone: an upload is indexed
+# before the generation using it is committed
+ORPHAN_GRACE_SECONDS = int(os.getenv("ORPHAN_GRACE_SECONDS", "3600"))
+# Rows handled per statement, statements per policy and sweep, and seconds between sweeps
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_MAX_BATCHES = int(os.getenv("RETENTION_MAX_BATCHES", "20"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "300"))
+
+TERMINAL_STATUSES = ("completed", "error", "cancelled")
+
+# A later submission of the same upload restarts its grace period
+RECORD_FILE = text("""
+    INSERT INTO stored_files (path, kind, generation_id, size_bytes, recorded_at)
+    VALUES (:path, :kind, :generation_id, :size_bytes, :recorded_at)
+    ON CONFLICT (path) DO UPDATE SET recorded_at = excluded.recorded_at
+""")
+BACKFILL_FILE = text("""
+    INSERT INTO stored_files (path, kind, generation_id, size_bytes, recorded_at)
+    VALUES (:path, :kind, :generation_id, :size_bytes, :recorded_at)
+    ON CONFLICT (path) DO NOTHING
+""")
+
+# Outer status check: with several API processes, each generation expires once.
+# Generations whose task is dead-lettered are kept until it is replayed, they
+# only hold their upload
+EXPIRE_GENERATIONS = text("""
+    UPDATE generations
+    SET status = 'expired', output_image_path = NULL,
+        preview_image_path = NULL, thumbnail_image_path = NULL
+    WHERE status IN :statuses AND id IN (
+        SELECT id FROM generations
+        WHERE status IN :statuses AND created_at < :cutoff AND dead_lettered_at IS NULL
+        ORDER BY created_at, id
+        LIMIT :limit
+    )
+    RETURNING id, input_image_path
+""").bindparams(bindparam("statuses", expanding=True))
+
+# Deletes the index rows of the given files that are still unreferenced and
+# old enough; only the process whose DELETE returned a row removes the file.
+# An upload submitted again meanwhile has had its row bumped, which the
+# DELETE re-checks once it holds the row
+DELETE_ORPHANS = text("""
+    DELETE FROM stored_files
+    WHERE path IN :paths AND (
+        (kind = 'upload' AND recorded_at < :upload_cutoff AND NOT EXISTS (
+            SELECT 1 FROM generations g
+            WHERE g.input_image_path = stored_files.path AND g.status <> 'expired'
+        ))
+        OR (kind = 'output' AND recorded_at < :output_cutoff AND NOT EXISTS (
+            SELECT 1 FROM generations g
+            WHERE g.id = stored_files.generation_id
+            AND stored_files.path IN (g.output_image_path, g.preview_image_path, g.thumbnail_image_path)
+        ))
+    )
+    RETURNING path, kind, size_bytes
+""").bindparams(bindparam("paths", expanding=True))
+
+
+def _file_rows(kind: str, paths: Iterable[str], generation_id: Optional[str], from_mtime: bool = False) -> List[dict]:
+    rows = []
+    now = datetime.now()
+    for path in paths:
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            continue
+        rows.append({
+            "path": path,
+            "kind": kind,
+            "generation_id": generation_id,
+            "size_bytes": stat_result.st_size,
+            "recorded_at": datetime.fromtimestamp(stat_result.st_mtime) if from_mtime else now
+        })
+    return rows
+
+
+async def record_files(session, kind: str, paths: Iterable[str], generation_id: Optional[str] = None):
+    """Add files just written to the index, in ``session``'s transaction.
+
+    ``kind`` is "upload" or "output"; outputs are recorded with the generation
+    they were written for.
+    """
+    rows = _file_rows(kind, paths, generation_id)
+    if rows:
+        await session.execute(RECORD_FILE, rows)
+
+
+def free_disk_bytes(path: str = ".") -> int:
+    return shutil.disk_usage(path).free
+
+
+def _remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class RetentionService:
+    """Applies the retention policies in periodic, bounded sweeps.
+
+    Each sweep expires generations by age, checks one window of the file index
+    for orphans, and then expires the oldest finished generations while the
+    quota is exceeded or the disk is low. Every statement handles at most
+    ``batch_size`` rows, and each policy runs at most ``max_batches`` of them
+    per sweep, so a large backlog is worked off over several sweeps.
+    """
+
+    def __init__(
+        self,
+        interval: float = RETENTION_INTERVAL,
+        batch_size: int = RETENTION_BATCH_SIZE,
+        max_batches: int = RETENTION_MAX_BATCHES,
+        derivatives=None
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        # Cache of resized outputs, dropped first when the disk runs low
+        self.derivatives = derivatives
+        # Last (recorded_at, path) checked by the orphan sweep
+        self._cursor: Optional[Tuple[datetime, str]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _delete_orphans(self, paths: List[str], upload_cutoff: datetime, output_cutoff: datetime) -> int:
+        """Delete those of ``paths`` no generation references, returning the bytes freed"""
+        if not paths:
+            return 0
+        async with async_session() as session:
+            result = await session.execute(
+                DELETE_ORPHANS,
+                {"paths": paths, "upload_cutoff": upload_cutoff, "output_cutoff": output_cutoff}
+            )
+            deleted = result.fetchall()
+            # Files go before the commit, while the deleted rows are still
+            # locked: a re-upload of the same content waits for the commit and
+            # then finds the file gone and writes it again. A failed commit
+            # leaves index rows of missing files, deleted on a later sweep
+            await run_in_threadpool(_remove_files, [row.path for row in deleted])
+            await session.commit()
+        for row in deleted:
+            FILES_DELETED.labels(kind=row.kind).inc()
+        return sum(row.size_bytes for row in deleted)
+
+    async def expire(self, statuses: Tuple[str, ...], cutoff: datetime, policy: str) -> Tuple[int, int]:
+        """Expire one batch of the oldest generations in ``statuses`` created before
+        ``cutoff`` and delete the files they held, returning (generations, bytes freed)"""
+        async with async_session() as session:
+            result = await session.execute(
+                EXPIRE_GENERATIONS,
+                {"statuses": list(statuses), "cutoff": cutoff, "limit": self.batch_size}
+            )
+            expired = result.fetchall()
+            await session.commit()
+            if not expired:
+                return 0, 0
+            GENERATIONS_EXPIRED.labels(policy=policy).inc(len(expired))
+
+            result = await session.execute(
+                text("SELECT path FROM stored_files WHERE generation_id IN :ids")
+                .bindparams(bindparam("ids", expanding=True)),
+                {"ids": [row.id for row in expired]}
+            )
+            outputs = [row.path for row in result]
+
+        now = datetime.now()
+        uploads = list({row.input_image_path for row in expired})
+        # Outputs of an expired generation are released at once, uploads only
+        # after the grace period since they may have just been submitted again
+        freed = await self._delete_orphans(
+            outputs + uploads, now - timedelta(seconds=ORPHAN_GRACE_SECONDS), now
+        )
+        return len(expired), freed
+
+    async def collect_orphans(self) -> int:
+        """Check the next window of the file index for unreferenced files, returning the bytes freed"""
+        cutoff = datetime.now() - timedelta(seconds=ORPHAN_GRACE_SECONDS)
+        conditions = ["recorded_at < :cutoff"]
+        params = {"cutoff": cutoff, "limit": self.batch_size}
+        if self._cursor:
+            params["cursor_recorded_at"], params["cursor_path"] = self._cursor
+            conditions.append("(recorded_at, path) > (:cursor_recorded_at, :cursor_path)")
+        async with async_session() as session:
+            result = await session.execute(
+                text(f"""
+                SELECT path, recorded_at FROM stored_files
+                WHERE {' AND '.join(conditions)}
+                ORDER BY recorded_at, path
+                LIMIT :limit
+                """),
+                params
+            )
+            window = result.fetchall()
+        # Start over from the oldest files once the end of the index is reached
+        self._cursor = (window[-1].recorded_at, window[-1].path) if len(window) == self.batch_size else None
+        return await self._delete_orphans([row.path for row in window], cutoff, cutoff)
+
+    async def sweep(self):
+        now = datetime.now()
+        age_policies = []
+        if RETENTION_DAYS:
+            age_policies.append((("completed",), now - timedelta(days=RETENTION_DAYS), "age"))
+        if FAILED_RETENTION_HOURS:
+            age_policies.append((("error", "cancelled"), now - timedelta(hours=FAILED_RETENTION_HOURS), "failed"))
+        for statuses, cutoff, policy in age_policies:
+            for _ in range(self.max_batches):
+                count, _ = await self.expire(statuses, cutoff, policy)
+                if count < self.batch_size:
+                    break
+
+        await self.collect_orphans()
+
+        async with async_session() as session:
+            result = await session.execute(text("SELECT COALESCE(SUM(size_bytes), 0) FROM stored_files"))
+            stored_bytes = int(result.scalar())
+
+        # Evict early, oldest finished generations first
+        for _ in range(self.max_batches):
+            over_quota = stored_bytes - STORAGE_QUOTA_MB * 1024**2 if STORAGE_QUOTA_MB else 0
+            low_disk = MIN_FREE_DISK_MB * 1024**2 - free_disk_bytes()
+            if over_quota <= 0 and low_disk <= 0:
+                break
+            if low_disk > 0 and self.derivatives is not None:
+                # Resized copies are cheapest to give up, they are made again on request
+                freed = await run_in_threadpool(self.derivatives.trim, 0)
+                if freed:
+                    print(f"Low disk space, dropped {freed / 1024**2:.1f} MB of resized images")
+                    continue
+            policy = "low_disk" if low_disk > 0 else "quota"
+            count, freed = await self.expire(TERMINAL_STATUSES, datetime.now(), policy)
+            if not count:
+                print(f"Retention: {policy} eviction found no finished generation to expire")
+                break
+            print(f"Retention: expired {count} generations ({policy}), freed {freed / 1024**2:.1f} MB")
+            stored_bytes -= freed
+
+        STORED_BYTES.set(stored_bytes)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Error applying retention policies: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+
+async def backfill(batch_size: int = RETENTION_BATCH_SIZE) -> int:
+    """Index the files in the upload and output directories, returning how many were checked.
+
+    Files already in the index are left as they are.
+    """
+    await init_db()
+    checked = 0
+    for directory, kind in ((UPLOAD_DIR, "upload"), (OUTPUT_DIR, "output")):
+        if not os.path.isdir(directory):
+            continue
+        names = sorted(entry.name for entry in os.scandir(directory) if entry.is_file() and not entry.name.startswith("."))
+        for start in range(0, len(names), batch_size):
+            paths = [f"{directory}/{name}" for name in names[start:start + batch_size]]
+            async with async_session() as session:
+                owners = {}
+                if kind == "output":
+                    result = await session.execute(
+                        text("""
+                        SELECT id, output_image_path, preview_image_path, thumbnail_image_path FROM generations
+                        WHERE output_image_path IN :paths OR preview_image_path IN :paths OR thumbnail_image_path IN :paths
+                        """).bindparams(bindparam("paths", expanding=True)),
+                        {"paths": paths}
+                    )
+                    for row in result:
+                        for path in (row.output_image_path, row.preview_image_path, row.thumbnail_image_path):
+                            owners[path] = row.id
+                # Outputs no generation claims are indexed without one and collected as orphans
+                rows = []
+                for path in paths:
+                    rows += _file_rows(kind, [path], owners.get(path), from_mtime=True)
+                if rows:
+                    await session.execute(BACKFILL_FILE, rows)
+                await session.commit()
+            checked += len(rows)
+    return checked
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        print("Usage: python retention.py backfill")
+        sys.exit(2)
+    print(f"Checked {asyncio.run(backfill())} files")
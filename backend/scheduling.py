@@ -0,0 +1,111 @@
+import asyncio
+import heapq
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Parse ``"tenant-a=4,tenant-b=2"`` into a weight per tenant"""
+    weights = {}
+    for entry in spec.split(","):
+        if "=" not in entry:
+            continue
+        tenant, weight = entry.split("=", 1)
+        weights[tenant.strip()] = float(weight)
+    return weights
+
+
+class FairScheduler:
+    """Admit tasks by priority, then by weighted fair share across tenants.
+
+    At most ``slots`` tasks hold a slot at once. When one is released, it goes
+    to the highest priority waiter; among waiters of that priority the tenant
+    with the least weighted service so far goes first, so a tenant with weight
+    2 is admitted twice as often as one with weight 1 while both are waiting.
+    A tenant that was idle re-enters at the current virtual time instead of
+    with credit saved up, and each tenant's own tasks stay in arrival order.
+    """
+
+    def __init__(self, slots: int, weights: Optional[Dict[str, float]] = None, default_weight: float = 1.0):
+        self.slots = slots
+        self.weights = weights or {}
+        self.default_weight = default_weight
+
+        self._in_use = 0
+        self._virtual_time = 0.0
+        self._tenant_time: Dict[str, float] = {}
+        # Per priority, FIFO of waiters of each tenant with something waiting
+        self._waiting: Dict[int, Dict[str, Deque[asyncio.Future]]] = {}
+        # (-priority, tenant virtual time, sequence, tenant) of tenants with waiters
+        self._heap: List[Tuple[int, float, int, str]] = []
+        self._sequence = itertools.count()
+
+    def weight(self, tenant: str) -> float:
+        return self.weights.get(tenant, self.default_weight)
+
+    def pending(self) -> int:
+        return sum(len(queue) for tenants in self._waiting.values() for queue in tenants.values())
+
+    async def acquire(self, priority: int, tenant: str):
+        if self._in_use < self.slots and not self._heap:
+            self._charge(tenant)
+            self._in_use += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        tenants = self._waiting.setdefault(priority, {})
+        queue = tenants.get(tenant)
+        if queue is None:
+            queue = tenants[tenant] = deque()
+            self._push_tenant(priority, tenant)
+        queue.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just before the waiter went away
+                self.release()
+            elif future in queue:
+                queue.remove(future)
+            raise
+
+    @asynccontextmanager
+    async def slot(self, priority: int, tenant: str):
+        await self.acquire(priority, tenant)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self):
+        self._in_use -= 1
+        while self._heap and self._in_use < self.slots:
+            negated_priority, _, _, tenant = heapq.heappop(self._heap)
+            priority = -negated_priority
+            queue = self._waiting[priority][tenant]
+            while queue and queue[0].done():
+                queue.popleft()
+            if not queue:
+                del self._waiting[priority][tenant]
+                continue
+
+            self._charge(tenant)
+            self._in_use += 1
+            queue.popleft().set_result(None)
+            if queue:
+                self._push_tenant(priority, tenant)
+            else:
+                del self._waiting[priority][tenant]
+
+    def _push_tenant(self, priority: int, tenant: str):
+        # Idle tenants catch up to the current virtual time
+        start = max(self._tenant_time.get(tenant, 0.0), self._virtual_time)
+        self._tenant_time[tenant] = start
+        heapq.heappush(self._heap, (-priority, start, next(self._sequence), tenant))
+
+    def _charge(self, tenant: str):
+        start = max(self._tenant_time.get(tenant, 0.0), self._virtual_time)
+        self._virtual_time = start
+        self._tenant_time[tenant] = start + 1 / self.weight(tenant)
@@ -0,0 +1,31 @@
+"""Download the worker's models into MODEL_SNAPSHOT_DIR as safetensors snapshots.
+
+Run once when building an image or volume, then start workers with the same
+MODEL_SNAPSHOT_DIR so they load from disk without resolving anything on the hub:
+
+    MODEL_SNAPSHOT_DIR=/models python snapshot_models.py
+"""
+import sys
+
+from huggingface_hub import snapshot_download
+
+from components import MODEL_SNAPSHOT_DIR, model_location
+from generation_config import BASE_MODEL_ID, CONTROLNET_MODELS, DWPOSE_MODEL_ID, DWPOSE_DETECTOR_FILE, DWPOSE_POSE_FILE
+
+# Only the weights the worker loads, skipping .bin/.ckpt duplicates of each model
+SNAPSHOTS = {
+    BASE_MODEL_ID: ["*.json", "*.txt", "*/diffusion_pytorch_model.safetensors", "*/model.safetensors"],
+    **{model_id: ["*.json", "diffusion_pytorch_model.safetensors"] for model_id in CONTROLNET_MODELS.values()},
+    # MiDaS annotator weights used by the depth preprocessor
+    "lllyasviel/Annotators": ["dpt_hybrid-midas-501f0c75.pt"],
+    # ONNX models of the DWpose pose preprocessor
+    DWPOSE_MODEL_ID: [DWPOSE_DETECTOR_FILE, DWPOSE_POSE_FILE],
+}
+
+if __name__ == "__main__":
+    if not MODEL_SNAPSHOT_DIR:
+        sys.exit("MODEL_SNAPSHOT_DIR is not set")
+    for repo_id, allow_patterns in SNAPSHOTS.items():
+        print(f"Downloading {repo_id}...")
+        snapshot_download(repo_id, local_dir=model_location(repo_id), allow_patterns=allow_patterns)
+    print(f"Models saved to {MODEL_SNAPSHOT_DIR}")
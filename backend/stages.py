@@ -0,0 +1,66 @@
+import asyncio
+import time
+import traceback
+from typing import Any, Awaitable, Callable, List, Optional
+
+from metrics import STAGE_QUEUE_DEPTH, STAGE_QUEUE_WAIT, STAGE_LATENCY
+
+
+class Stage:
+    """A processing stage fed by a bounded queue and drained by N workers.
+
+    Each job is passed to ``handler``; on success it is forwarded to
+    ``next_stage`` (waiting while that stage's queue is full, so back-pressure
+    propagates upstream), on failure ``on_error(job, exc)`` is called and the
+    job leaves the pipeline.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[None]],
+        concurrency: int = 1,
+        maxsize: int = 1,
+        next_stage: Optional["Stage"] = None,
+        on_error: Optional[Callable[[Any, Exception], None]] = None
+    ):
+        self.name = name
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.next_stage = next_stage
+        self.on_error = on_error
+        self._workers: List[asyncio.Task] = []
+
+    def start(self):
+        if self._workers:
+            return
+        self._workers = [
+            asyncio.create_task(self._work()) for _ in range(self.concurrency)
+        ]
+
+    async def put(self, job: Any):
+        self.start()
+        await self.queue.put((time.monotonic(), job))
+        STAGE_QUEUE_DEPTH.labels(stage=self.name).set(self.queue.qsize())
+
+    async def _work(self):
+        while True:
+            enqueued_at, job = await self.queue.get()
+            STAGE_QUEUE_DEPTH.labels(stage=self.name).set(self.queue.qsize())
+            started_at = time.monotonic()
+            STAGE_QUEUE_WAIT.labels(stage=self.name).observe(started_at - enqueued_at)
+            try:
+                await self.handler(job)
+            except Exception as e:
+                print(f"Error in {self.name} stage: {str(e)}")
+                traceback.print_exc()
+                if self.on_error:
+                    self.on_error(job, e)
+                continue
+            finally:
+                STAGE_LATENCY.labels(stage=self.name).observe(time.monotonic() - started_at)
+                self.queue.task_done()
+
+            if self.next_stage is not None:
+                await self.next_stage.put(job)
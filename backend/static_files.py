@@ -0,0 +1,166 @@
+import hashlib
+import os
+import stat
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, QueryParams
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+# Files under the static mounts never change once written (uploads are named by
+# content hash, outputs by a fresh uuid), so clients and CDNs may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Widths offered by the ?w= resize parameter; a fixed set bounds the cache
+RESIZE_WIDTHS = sorted(int(w) for w in os.getenv("RESIZE_WIDTHS", "64,128,256,512,768,1024").split(","))
+DERIVATIVE_CACHE_DIR = os.getenv("DERIVATIVE_CACHE_DIR", "derivatives")
+DERIVATIVE_CACHE_MAX_MB = int(os.getenv("DERIVATIVE_CACHE_MAX_MB", "512"))
+
+
+def strong_etag(identity: str) -> str:
+    return '"' + hashlib.sha256(identity.encode()).hexdigest()[:32] + '"'
+
+
+class DerivativeCache:
+    """Disk-backed, size-bounded LRU cache of resized copies of static files.
+
+    The index is rebuilt from the directory in modification time order on
+    startup. Hits only reorder the in-memory index, so a derivative's
+    Last-Modified and ETag stay the same for as long as it is cached.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat_result = entry.stat()
+                entries.append((stat_result.st_mtime, entry.name, stat_result.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._total_bytes += size
+        self._evict()
+
+    def get_or_create(self, source_path: str, source_stat: os.stat_result, width: int) -> Tuple[str, os.stat_result]:
+        """Path and stat of ``source_path`` resized to ``width``, encoding it on a miss.
+
+        Images already at most ``width`` wide are never upscaled, the source is
+        returned instead.
+        """
+        extension = os.path.splitext(source_path)[1]
+        source_identity = f"{source_path}:{source_stat.st_size}:{source_stat.st_mtime_ns}"
+        name = hashlib.sha256(f"{source_identity}:{width}".encode()).hexdigest() + extension
+        path = os.path.join(self.directory, name)
+
+        with self._lock:
+            if name in self._index:
+                try:
+                    # Recency is tracked in memory only: touching the file would
+                    # change its Last-Modified on every hit
+                    stat_result = os.stat(path)
+                    self._index.move_to_end(name)
+                    return path, stat_result
+                except FileNotFoundError:
+                    self._total_bytes -= self._index.pop(name)
+
+        tmp_path = os.path.join(self.directory, f".{uuid.uuid4()}.tmp")
+        with Image.open(source_path) as image:
+            if width >= image.width:
+                return source_path, source_stat
+            image_format = image.format
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+        resized.save(tmp_path, format=image_format)
+        os.replace(tmp_path, path)
+        stat_result = os.stat(path)
+
+        with self._lock:
+            if name in self._index:
+                self._total_bytes -= self._index.pop(name)
+            self._index[name] = stat_result.st_size
+            self._total_bytes += stat_result.st_size
+            self._evict(keep=name)
+        return path, stat_result
+
+    def trim(self, max_bytes: int) -> int:
+        """Evict entries until at most ``max_bytes`` remain, e.g. when the disk runs low, returning the bytes freed"""
+        with self._lock:
+            before = self._total_bytes
+            self._evict(max_bytes=max_bytes)
+            return before - self._total_bytes
+
+    def _evict(self, keep: Optional[str] = None, max_bytes: Optional[int] = None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        while self._index and self._total_bytes > max_bytes:
+            name, size = next(iter(self._index.items()))
+            if name == keep:
+                break
+            del self._index[name]
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles for write-once files.
+
+    Responses carry a strong ETag and an immutable Cache-Control header, and
+    conditional (If-None-Match / If-Modified-Since) and Range requests are
+    answered by Starlette. With a derivative cache, ``?w=<width>`` serves a
+    downscaled copy, created on first request.
+    """
+
+    def __init__(self, *args, derivatives: Optional[DerivativeCache] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.derivatives = derivatives
+
+    async def get_response(self, path: str, scope) -> Response:
+        width = QueryParams(scope["query_string"]).get("w")
+        if width is None or self.derivatives is None:
+            return await super().get_response(path, scope)
+
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405)
+        if not width.isdigit() or int(width) not in RESIZE_WIDTHS:
+            raise HTTPException(status_code=400, detail=f"w must be one of {RESIZE_WIDTHS}")
+
+        full_path, stat_result = await run_in_threadpool(self.lookup_path, path)
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            raise HTTPException(status_code=404)
+
+        derivative_path, derivative_stat = await run_in_threadpool(
+            self.derivatives.get_or_create, full_path, stat_result, int(width)
+        )
+        if derivative_path == full_path:
+            return self.file_response(full_path, stat_result, scope)
+        # The cache key already names the source version and width, and stays
+        # the same when an evicted derivative is encoded again
+        return self.file_response(
+            derivative_path, derivative_stat, scope, identity=os.path.basename(derivative_path)
+        )
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200,
+                      identity: Optional[str] = None) -> Response:
+        request_headers = Headers(scope=scope)
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        if identity is None:
+            identity = f"{full_path}:{stat_result.st_size}:{stat_result.st_mtime_ns}"
+        response.headers["etag"] = strong_etag(identity)
+        response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
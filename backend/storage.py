@@ -0,0 +1,101 @@
+import hashlib
+import os
+import uuid
+from typing import Tuple
+
+from fastapi import UploadFile
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+UPLOAD_DIR = "uploads"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "20")) * 1024**2
+
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the configured size limit"""
+
+
+def _write_chunk(buffer, digest, chunk: bytes):
+    digest.update(chunk)
+    buffer.write(chunk)
+
+
+async def save_upload(upload: UploadFile, directory: str = UPLOAD_DIR, max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[str, str]:
+    """Stream an upload to a content-addressed file and return (path, sha256).
+
+    The file is read in chunks and hashed while it is written, with all file
+    I/O done in the threadpool. Identical uploads resolve to the same path and
+    the duplicate copy is discarded.
+    """
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".{uuid.uuid4()}.part")
+    digest = hashlib.sha256()
+    size = 0
+
+    buffer = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Upload exceeds {max_bytes // 1024**2} MB limit")
+            await run_in_threadpool(_write_chunk, buffer, digest, chunk)
+    except BaseException:
+        await run_in_threadpool(buffer.close)
+        await run_in_threadpool(_remove_quietly, tmp_path)
+        raise
+    await run_in_threadpool(buffer.close)
+
+    sha256 = digest.hexdigest()
+    path = f"{directory}/{sha256}.png"
+    await run_in_threadpool(_commit_blob, tmp_path, path)
+    return path, sha256
+
+
+def read_image_size(path: str) -> Tuple[int, int]:
+    """Width and height from the image header, without decoding the pixels.
+
+    Raises PIL's UnidentifiedImageError for files that are not images and
+    DecompressionBombError for sizes far beyond Image.MAX_IMAGE_PIXELS.
+    """
+    with Image.open(path) as image:
+        return image.size
+
+
+def _commit_blob(tmp_path: str, path: str):
+    if os.path.exists(path):
+        # Same content already stored, keep the existing blob
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class UploadLimitMiddleware:
+    """Reject uploads whose Content-Length exceeds the limit before the body is read"""
+
+    def __init__(self, app, paths: Tuple[str, ...], max_bytes: int = MAX_UPLOAD_BYTES):
+        self.app = app
+        self.paths = paths
+        # Leave room for the multipart framing and the other form fields
+        self.max_body_bytes = max_bytes + 64 * 1024
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in self.paths:
+            headers = dict(scope["headers"])
+            content_length = headers.get(b"content-length")
+            if content_length and content_length.isdigit() and int(content_length) > self.max_body_bytes:
+                response = JSONResponse({"detail": "Uploaded image is too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
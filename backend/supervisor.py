@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import torch
+
+from pipeline_cache import module_size_bytes
+
+
+def share_weights(objects: Iterable[Any]) -> int:
+    """Move the weights of the torch modules in ``objects`` to shared memory.
+
+    Modules held as attributes (a detector's ``model``) are included. Forked
+    processes then map the same pages instead of copying them on first touch.
+    Returns the bytes shared, 0 when /dev/shm is too small to hold them.
+    """
+    modules: Dict[int, torch.nn.Module] = {}
+    for obj in objects:
+        candidates = [obj] if isinstance(obj, torch.nn.Module) else list(getattr(obj, "__dict__", {}).values())
+        for candidate in candidates:
+            if isinstance(candidate, torch.nn.Module):
+                modules[id(candidate)] = candidate
+
+    total = sum(module_size_bytes(module) for module in modules.values())
+    free = shutil.disk_usage("/dev/shm").free if os.path.isdir("/dev/shm") else 0
+    if total > free:
+        print(
+            f"Not enough shared memory for {total / 1024**3:.2f} GB of weights "
+            f"({free / 1024**3:.2f} GB free in /dev/shm), workers share them copy-on-write"
+        )
+        return 0
+    for module in modules.values():
+        module.share_memory()
+    return total
+
+
+class Supervisor:
+    """Runs ``count`` forked processes of ``target(index)`` and restarts those that exit.
+
+    Processes that die within ``min_uptime`` seconds of starting are restarted
+    with exponential backoff. SIGTERM or SIGINT stops every process and returns.
+    """
+
+    def __init__(self, count: int, target: Callable[[int], None], min_uptime: float = 30.0, max_backoff: float = 60.0):
+        self.count = count
+        self.target = target
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+        # Fork, so the processes inherit the models loaded by the parent
+        self._context = multiprocessing.get_context("fork")
+        self._processes: Dict[int, Optional[multiprocessing.Process]] = {}
+        self._started_at: Dict[int, float] = {}
+        self._failures: Dict[int, int] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._stopping = False
+
+    def _run_child(self, index: int):
+        # Forked children inherit the supervisor's handlers
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.target(index)
+
+    def _start(self, index: int):
+        process = self._context.Process(
+            target=self._run_child, args=(index,), name=f"worker-{index}", daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        print(f"Started worker process {index} (pid {process.pid})")
+
+    def _reap(self, index: int):
+        process = self._processes[index]
+        process.join()
+        uptime = time.monotonic() - self._started_at[index]
+        self._failures[index] = self._failures.get(index, 0) + 1 if uptime < self.min_uptime else 0
+        delay = min(self.max_backoff, 2 ** self._failures[index] - 1)
+        print(
+            f"Worker process {index} (pid {process.pid}) exited with code {process.exitcode} "
+            f"after {uptime:.0f}s, restarting in {delay:.0f}s"
+        )
+        self._processes[index] = None
+        self._restart_at[index] = time.monotonic() + delay
+
+    def stop(self, *_):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.count):
+            self._start(index)
+
+        try:
+            while not self._stopping:
+                sentinels = {
+                    process.sentinel: index
+                    for index, process in self._processes.items()
+                    if process is not None
+                }
+                for sentinel in wait(list(sentinels), timeout=1.0):
+                    self._reap(sentinels[sentinel])
+
+                now = time.monotonic()
+                for index, restart_at in list(self._restart_at.items()):
+                    if restart_at <= now and not self._stopping:
+                        del self._restart_at[index]
+                        self._start(index)
+        finally:
+            self._shutdown()
+
+    def _shutdown(self, timeout: float = 30.0):
+        print("Stopping worker processes...")
+        running = [process for process in self._processes.values() if process is not None and process.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in running:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
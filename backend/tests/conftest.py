@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Modules create their engine on import, the tests never need Postgres
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite+aiosqlite:///{os.path.join(tempfile.gettempdir(), 'sd_controlnet_tests.sqlite')}"
+)
+
+import local_broker
+
+local_broker.install()
+
+
+@pytest.fixture(autouse=True)
+def broker():
+    """A fresh in-process broker for each test"""
+    local_broker.broker = local_broker.LocalBroker()
+    yield local_broker.broker
@@ -0,0 +1,44 @@
+import asyncio
+import json
+
+import aio_pika
+import pytest
+
+import rabbitmq
+
+# The worker module loads the diffusers stack
+worker = pytest.importorskip("worker")
+
+
+def test_idle_worker_steals_tasks_of_other_preprocessors(monkeypatch):
+    handled = []
+
+    async def handle_task_message(message):
+        async with message.process():
+            handled.append((message.routing_key, json.loads(message.body)["id"]))
+
+    monkeypatch.setattr(worker, "WORKER_PREPROCESSORS", ["canny"])
+    monkeypatch.setattr(worker, "WORK_STEALING", True)
+    monkeypatch.setattr(worker, "STEAL_INTERVAL_MS", 5)
+    monkeypatch.setattr(worker, "handle_task_message", handle_task_message)
+
+    async def scenario():
+        await rabbitmq.init_rabbitmq()
+        await worker.consume_queue()
+        try:
+            await rabbitmq.publish_tasks([
+                (preprocessor, aio_pika.Message(body=json.dumps({"id": generation_id}).encode()))
+                for generation_id, preprocessor in (("a", "pose"), ("b", "canny"), ("c", "depth"), ("d", "pose"))
+            ])
+            for _ in range(100):
+                if len(handled) == 4:
+                    break
+                await asyncio.sleep(0.01)
+            assert not worker.steal_loop_task.done()
+        finally:
+            worker.steal_loop_task.cancel()
+            worker.queue_depth_task.cancel()
+            await rabbitmq.close_rabbitmq()
+
+    asyncio.run(scenario())
+    assert sorted(handled) == [("canny", "b"), ("depth", "c"), ("pose", "a"), ("pose", "d")]
@@ -0,0 +1,86 @@
+import json
+import os
+import secrets
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+# Print one JSON line per finished span, searchable by trace_id or generation id
+TRACE_LOG = os.getenv("TRACE_LOG", "true").lower() == "true"
+
+
+@dataclass(frozen=True)
+class TraceContext:
+    """W3C trace context (https://www.w3.org/TR/trace-context/) of one span"""
+    trace_id: str
+    span_id: str
+    sampled: bool = True
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def child(self) -> "TraceContext":
+        return TraceContext(self.trace_id, secrets.token_hex(8), self.sampled)
+
+
+def new_trace() -> TraceContext:
+    return TraceContext(secrets.token_hex(16), secrets.token_hex(8))
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[TraceContext]:
+    """The context in a ``traceparent`` header, None if missing or malformed"""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    version, trace_id, span_id, flags = parts[:4]
+    try:
+        int(trace_id, 16), int(span_id, 16), int(flags, 16)
+    except ValueError:
+        return None
+    if version == "ff" or set(trace_id) == {"0"} or set(span_id) == {"0"}:
+        return None
+    return TraceContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+
+def _log_span(name: str, context: TraceContext, parent: TraceContext, duration: float, attributes: dict):
+    if TRACE_LOG and context.sampled:
+        print(json.dumps({
+            "trace_id": context.trace_id,
+            "span_id": context.span_id,
+            "parent_id": parent.span_id,
+            "span": name,
+            "duration_ms": round(duration * 1000, 3),
+            **attributes,
+        }))
+
+
+def record_span(name: str, parent: Optional[TraceContext], duration: float, **attributes) -> Optional[TraceContext]:
+    """Log a span that already finished, such as time spent waiting in a queue"""
+    if parent is None:
+        return None
+    context = parent.child()
+    _log_span(name, context, parent, duration, attributes)
+    return context
+
+
+@contextmanager
+def span(name: str, parent: Optional[TraceContext], **attributes):
+    """Time the enclosed block as a child span of ``parent``.
+
+    Yields the span's own context so nested work and outgoing messages can be
+    parented to it. Without a parent nothing is recorded.
+    """
+    context = parent.child() if parent is not None else None
+    started_at = time.perf_counter()
+    try:
+        yield context
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        if context is not None:
+            _log_span(name, context, parent, time.perf_counter() - started_at, attributes)
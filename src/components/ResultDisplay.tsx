@@ -21,7 +21,7 @@ const ResultDisplay: React.FC = () => {
     let interval: NodeJS.Timeout;
 
     const pollGenerationStatus = async () => {
-      if (latestGeneration?.id && (latestGeneration.status === 'processing' || latestGeneration.status === 'uploading')) {
+      if (latestGeneration?.id && (latestGeneration.status === 'queued' || latestGeneration.status === 'processing' || latestGeneration.status === 'uploading')) {
         setIsPolling(true);
         setStatusMessage(`Processing with ${latestGeneration.preprocessor}...`);
         setImageLoadError(false);
@@ -35,6 +35,8 @@ const ResultDisplay: React.FC = () => {
             updateGeneration(latestGeneration.id, {
               status: response.status,
               resultUrl: response.resultUrl,
+              previewUrl: response.previewUrl,
+              thumbnailUrl: response.thumbnailUrl,
               output_image_path: response.resultUrl?.replace(`${API_URL}/`, ''),
               error: response.error,
             });
@@ -123,7 +125,7 @@ const ResultDisplay: React.FC = () => {
           </div>
         )}
 
-        {(latestGeneration?.status === 'processing' || latestGeneration?.status === 'uploading') && (
+        {(latestGeneration?.status === 'queued' || latestGeneration?.status === 'processing' || latestGeneration?.status === 'uploading') && (
           <div className="text-center p-8">
             <RefreshCw size={40} className="animate-spin mx-auto mb-4 text-primary-400" />
             <p className="text-lg text-primary-300 mb-2">{statusMessage}</p>
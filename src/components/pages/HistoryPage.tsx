@@ -24,7 +24,8 @@ const HistoryPage: React.FC = () => {
             {generation.resultUrl && (
               <div className="relative group">
                 <img 
-                  src={generation.resultUrl} 
+                  src={generation.thumbnailUrl ?? generation.resultUrl} 
+                  loading="lazy"
                   alt={generation.prompt} 
                   className="w-full h-48 object-cover rounded-lg mb-3"
                 />
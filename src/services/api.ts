@@ -15,6 +15,8 @@ export interface GenerationResponse {
   preprocessor: string;
   output_image_path?: string;
   resultUrl?: string;
+  previewUrl?: string;
+  thumbnailUrl?: string;
   error_message?: string;
   created_at: string;
 }
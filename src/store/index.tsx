@@ -7,7 +7,7 @@ export type Page = 'dashboard' | 'history' | 'about';
 // This should match your API response structure
 export interface Generation {
   id: string;
-  status: 'pending' | 'processing' | 'completed' | 'error';
+  status: 'pending' | 'queued' | 'processing' | 'completed' | 'error' | 'cancelled' | 'expired';
   prompt: string;
   preprocessor: 'canny' | 'pose' | 'depth';
   output_image_path?: string;
@@ -15,6 +15,8 @@ export interface Generation {
   created_at: string;
   // Frontend-specific fields
   resultUrl?: string;
+  previewUrl?: string;
+  thumbnailUrl?: string;
   error?: string;
 }
 